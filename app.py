@@ -1,95 +1,760 @@
-import os, json, time, uuid, random, math, hashlib, hmac
-from flask import Flask, request, jsonify, send_from_directory, redirect, url_for
+import os, sys, json, time, uuid, random, math, hashlib, hmac, threading, sqlite3, atexit, base64, shutil, tempfile
+import socket, selectors, subprocess
+import click
+from abc import ABC, abstractmethod
+import requests
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, request, jsonify, send_from_directory, redirect, url_for, stream_with_context, g, has_request_context
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.dialects import sqlite as sqlite_dialect, postgresql as postgresql_dialect
 from datetime import datetime, timedelta
-from functools import wraps
+from decimal import Decimal, DecimalException, ROUND_HALF_UP
+from functools import wraps, lru_cache
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-change-in-prod')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///tma_bot.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['COMMIT_AUDIT'] = os.environ.get('COMMIT_AUDIT') == '1'  # adds X-DB-Commits to every response
+
+# ─── DATABASE PROFILE ───────────────────────────────────────────
+# Engine settings picked from the DATABASE_URL backend. SQLite gets WAL (readers
+# no longer block on a writer, commits append to the log instead of rewriting
+# the journal), synchronous=NORMAL (no fsync per commit in WAL mode), a busy
+# timeout so a worker waits for the write lock instead of failing, and mmap'd
+# reads. Postgres gets a sized, pre-pinged pool and a server-side statement
+# timeout. DB_PROFILE=0 keeps SQLAlchemy's defaults.
+DB_PROFILE = os.environ.get('DB_PROFILE', '1') != '0'
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 5000))
+SQLITE_BUSY_TIMEOUT_MS = 5000
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': SQLITE_BUSY_TIMEOUT_MS,
+    'mmap_size': 256 * 1024 * 1024,
+}
+
+def engine_options(url):
+    """create_engine() options for the backend behind `url`"""
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend == 'postgresql':
+        return {'pool_size': DB_POOL_SIZE, 'max_overflow': DB_MAX_OVERFLOW, 'pool_pre_ping': True,
+                'pool_recycle': 1800, 'connect_args': {'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}'}}
+    if backend == 'sqlite' and url.database not in (None, '', ':memory:'):  # in-memory uses a StaticPool
+        return {'pool_size': DB_POOL_SIZE, 'max_overflow': DB_MAX_OVERFLOW,
+                'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000}}
+    return {}
+
+def apply_sqlite_pragmas(dbapi_conn, record):
+    cursor = dbapi_conn.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+def without_statement_timeout(conn):
+    """Lift DB_STATEMENT_TIMEOUT_MS for the rest of `conn`'s transaction (migrations, reconciles, exports)"""
+    if conn.dialect.name == 'postgresql':
+        conn.exec_driver_sql('SET LOCAL statement_timeout = 0')
+
+def configure_engine(engine):
+    """Per-connection settings that can't go through create_engine() options"""
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', apply_sqlite_pragmas)
+
+if DB_PROFILE:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 
 db = SQLAlchemy(app)
 
+if DB_PROFILE:
+    with app.app_context():
+        configure_engine(db.engine)
+
 # ─── TELEGRAM BOT TOKEN & ADMIN ─────────────────────────────────
 BOT_TOKEN = os.environ.get('BOT_TOKEN', 'YOUR_BOT_TOKEN')
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
 ADMIN_CHAT_ID = os.environ.get('ADMIN_CHAT_ID', 'YOUR_ADMIN_ID')
 TON_API_KEY = os.environ.get('TON_API_KEY', '')
 
+# ─── MONEY ──────────────────────────────────────────────────────
+# Amounts are integer nano-TON everywhere in the app and the DB; TON floats
+# only exist in request/response JSON.
+NANO = 10**9
+STARS_NANO = 10_990_000  # nano-TON per Star: 100 Stars = 1.099 TON
+MAX_NANO = 2**63 - 1  # money columns are 64-bit integers
+
+class InvalidAmount(ValueError):
+    """A request's number isn't finite or doesn't fit a money column; answered with 400"""
+
+def to_nano(ton):
+    """JSON TON amount -> integer nano-TON (decimal rounding, no float drift)"""
+    try:
+        nano = (Decimal(str(ton)) * NANO).to_integral_value(ROUND_HALF_UP)
+    except DecimalException:  # not a number, or too large to represent
+        raise InvalidAmount(ton) from None
+    if not nano.is_finite() or abs(nano) > MAX_NANO:
+        raise InvalidAmount(ton)
+    return int(nano)
+
+def stars_to_nano(stars):
+    """JSON Star count -> integer nano-TON"""
+    try:
+        nano = int(stars) * STARS_NANO
+    except (TypeError, ValueError, OverflowError):  # OverflowError: int(inf)
+        raise InvalidAmount(stars) from None
+    if abs(nano) > MAX_NANO:
+        raise InvalidAmount(stars)
+    return nano
+
+def to_finite(number):
+    """JSON number that isn't money (e.g. a multiplier) -> float"""
+    try:
+        number = float(number)
+    except (TypeError, ValueError):
+        raise InvalidAmount(number) from None
+    if not math.isfinite(number):
+        raise InvalidAmount(number)
+    return number
+
+@app.errorhandler(InvalidAmount)
+def invalid_amount(e):
+    return jsonify({'error': 'Invalid amount'}), 400
+
+def from_nano(nano):
+    return None if nano is None else nano / NANO
+
 # ─── MODELS ─────────────────────────────────────────────────────
 class User(db.Model):
-    id = db.Column(db.BigInteger, primary_key=True)
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)  # SQLite only autoincrements INTEGER
     telegram_id = db.Column(db.BigInteger, unique=True, nullable=False)
     first_name = db.Column(db.String(100))
     last_name = db.Column(db.String(100))
     username = db.Column(db.String(100))
     photo_url = db.Column(db.Text)
-    balance = db.Column(db.Float, default=0.0)
-    total_deposited = db.Column(db.Float, default=0.0)
+    balance = db.Column(db.BigInteger, default=0)          # nano-TON
+    total_deposited = db.Column(db.BigInteger, default=0)  # nano-TON
     games_played = db.Column(db.Integer, default=0)
     ref_id = db.Column(db.BigInteger, nullable=True)  # who referred this user
     ref_percent = db.Column(db.Float, default=10.0)   # referral bonus %
-    ref_balance = db.Column(db.Float, default=0.0)    # accumulated ref earnings
+    ref_balance = db.Column(db.BigInteger, default=0)  # accumulated ref earnings, nano-TON
+    ref_count = db.Column(db.Integer, default=0)         # users this one referred
+    ref_deposited = db.Column(db.BigInteger, default=0)  # their total deposits, nano-TON
+    ref_earned = db.Column(db.BigInteger, default=0)     # lifetime commission, nano-TON
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_online = db.Column(db.DateTime, default=datetime.utcnow)
     free_case_last = db.Column(db.DateTime, nullable=True)
 
+    __table_args__ = (
+        db.Index('ix_user_ref_created', 'ref_id', 'created_at'),  # referral list pages
+        db.Index('ix_user_last_online', 'last_online'),          # admin online counters
+        db.Index('ix_user_total_deposited', 'total_deposited'),  # leaderboard rebuild
+    )
+
 class GameHistory(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.BigInteger, db.ForeignKey('user.telegram_id'))
     game_type = db.Column(db.String(50))  # gift_upgrade, rolls, mutants
-    stake = db.Column(db.Float)
-    result = db.Column(db.Float)  # positive = win, negative = loss
+    stake = db.Column(db.BigInteger)   # nano-TON
+    result = db.Column(db.BigInteger)  # nano-TON, positive = win, negative = loss
     multiplier = db.Column(db.Float, nullable=True)
     details = db.Column(db.Text, nullable=True)  # JSON extra info
     played_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (db.Index('ix_game_history_user_played', 'user_id', 'played_at'),)
+
+class Gift(db.Model):
+    """Catalog of NFT gifts, keyed by the reward tables' names"""
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    name = db.Column(db.String(100), unique=True, nullable=False)
+    image = db.Column(db.String(200))
+    sell_price = db.Column(db.BigInteger)  # nano-TON per unit
+
 class Inventory(db.Model):
+    """How many of each gift a user holds; a sold-out row stays at quantity 0 for the next win"""
+    __tablename__ = 'inventory_stack'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    user_id = db.Column(db.BigInteger, db.ForeignKey('user.telegram_id'))
-    gift_name = db.Column(db.String(100))
-    gift_image = db.Column(db.String(200))
-    sell_price = db.Column(db.Float)
-    obtained_at = db.Column(db.DateTime, default=datetime.utcnow)
+    user_id = db.Column(db.BigInteger, db.ForeignKey('user.telegram_id'), nullable=False)
+    gift_id = db.Column(db.Integer, db.ForeignKey('gift.id'), nullable=False)
+    quantity = db.Column(db.Integer, default=0, nullable=False)
+    obtained_at = db.Column(db.DateTime, default=datetime.utcnow)  # last time one was added
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'gift_id', name='uq_inventory_stack_user_gift'),
+        db.Index('ix_inventory_stack_user_id', 'user_id', 'id'),  # pages: a stack's id never moves
+    )
+
+# One row per won item, replaced by Gift + Inventory in migration 3; kept out of
+# db.metadata so create_all never makes it, but older migrations still read it.
+legacy_metadata = db.MetaData()
+legacy_inventory = db.Table(
+    'inventory', legacy_metadata,
+    db.Column('id', db.Integer, primary_key=True, autoincrement=True),
+    db.Column('user_id', db.BigInteger),
+    db.Column('gift_name', db.String(100)),
+    db.Column('gift_image', db.String(200)),
+    db.Column('sell_price', db.BigInteger),
+    db.Column('obtained_at', db.DateTime),
+)
 
 class WithdrawalRequest(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.BigInteger, db.ForeignKey('user.telegram_id'))
-    amount = db.Column(db.Float)
+    amount = db.Column(db.BigInteger)  # nano-TON
     wallet_address = db.Column(db.Text)
     status = db.Column(db.String(20), default='pending')  # pending, approved, rejected
     admin_note = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_withdrawal_request_status_created', 'status', 'created_at'),  # admin queue
+        db.Index('ix_withdrawal_request_user_created', 'user_id', 'created_at'),   # user's history
+    )
+
 class DepositRecord(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.BigInteger, db.ForeignKey('user.telegram_id'))
-    amount = db.Column(db.Float)
+    amount = db.Column(db.BigInteger)  # nano-TON
     method = db.Column(db.String(20))  # 'ton', 'stars'
     status = db.Column(db.String(20), default='pending')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+class LedgerEntry(db.Model):
+    """Append-only record of every balance change"""
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.BigInteger, db.ForeignKey('user.telegram_id'))
+    account = db.Column(db.String(10), default='main')  # main, ref
+    delta = db.Column(db.BigInteger)  # nano-TON
+    balance_after = db.Column(db.BigInteger, nullable=True)  # not known for bulk settlements
+    reason = db.Column(db.String(30))  # gift_upgrade, rolls_bet, deposit_stars, ...
+    ref = db.Column(db.String(64), nullable=True)  # e.g. 'withdrawal:12'
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class StatCounter(db.Model):
+    """Running totals for the admin dashboard: users, total_deposited, reconciled_at"""
+    name = db.Column(db.String(32), primary_key=True)
+    value = db.Column(db.BigInteger, default=0)
+
+class RollsSettlement(db.Model):
+    """Single row: Rolls bets placed at or before settled_until (ms) are paid out"""
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    settled_until = db.Column(db.BigInteger, nullable=False)
+
+class OnlineBucket(db.Model):
+    """How many users have their last_online in this UTC minute (last 24h only)"""
+    minute = db.Column(db.Integer, primary_key=True, autoincrement=False)  # minutes since the epoch
+    users = db.Column(db.Integer, default=0)
+
+class Notification(db.Model):
+    """Outbox of Telegram messages, written in the same transaction as the change they report"""
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    chat_id = db.Column(db.String(64), nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(10), default='pending')  # pending, sent, failed
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)  # also the dispatcher's claim lease
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (db.Index('ix_notification_due', 'status', 'next_attempt_at'),)
+
+class IdempotencyKey(db.Model):
+    """A money-moving call claimed by its Idempotency-Key; status and body are its response once written"""
+    user_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    key = db.Column(db.String(64), primary_key=True)
+    fingerprint = db.Column(db.String(40), nullable=False)  # sha1 of path + body; a reused key must match
+    status = db.Column(db.SmallInteger, nullable=True)
+    body = db.Column(db.Text, nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (db.Index('ix_idempotency_key_expires', 'expires_at'),)
+
+# ─── BALANCE LEDGER ─────────────────────────────────────────────
+# Money only moves through single conditional UPDATEs — never read-modify-write
+# in Python — so concurrent requests on any worker can't lose updates.
+def apply_balance_delta(tid, delta, reason, ref=None, require=None, where=None, session=None, **values):
+    """Add `delta` to the user's balance and append a ledger entry.
+
+    `require` is the balance the user must hold beforehand (defaults to the amount
+    debited; 0 disables the check), `where` is an extra guard and `values` are other
+    columns to set in the same statement. Returns the new balance, or None if the
+    user doesn't exist or a guard failed — nothing is written in that case.
+    `session` defaults to db.session; the ASGI mode passes its own.
+    """
+    session = session or db.session
+    if require is None:
+        require = max(0, -delta)
+    stmt = db.update(User).where(User.telegram_id == tid)
+    if require:
+        stmt = stmt.where(User.balance >= require)
+    if where is not None:
+        stmt = stmt.where(where)
+    stmt = stmt.values(balance=User.balance + delta, **values).returning(User.balance)
+    row = session.execute(stmt, execution_options={'synchronize_session': False}).first()
+    if row is None:
+        return None
+    session.add(LedgerEntry(user_id=tid, delta=delta, balance_after=row[0], reason=reason, ref=ref))
+    mark_user_changed(tid, session=session)
+    return row[0]
+
+def credit_referrer(tid, amount, reason, session=None):
+    """Pay the referrer's commission on a nano-TON deposit in one UPDATE; returns the bonus or 0
+
+    The same UPDATE keeps the referrer's ref_deposited and ref_earned totals current.
+    """
+    session = session or db.session
+    referee = db.aliased(User)
+    referrer_id = db.select(referee.ref_id).where(referee.telegram_id == tid).scalar_subquery()
+    bonus = db.cast(amount * User.ref_percent / 100, db.BigInteger)
+    row = session.execute(
+        db.update(User).where(User.telegram_id == referrer_id)
+          .values(ref_balance=User.ref_balance + bonus, ref_earned=User.ref_earned + bonus,
+                  ref_deposited=User.ref_deposited + amount)
+          .returning(User.telegram_id, User.ref_balance, bonus),
+        execution_options={'synchronize_session': False}).first()
+    if row is None:
+        return 0
+    session.add(LedgerEntry(user_id=row[0], account='ref', delta=row[2], balance_after=row[1],
+                            reason=reason, ref=f'referee:{tid}'))
+    mark_user_changed(row[0], session=session)  # their referrals list shows this referee's deposits too
+    return row[2]
+
+def balance_error(tid, insufficient='Insufficient balance'):
+    """Response for a debit that didn't apply: unknown user or not enough money"""
+    if db.session.query(User.id).filter_by(telegram_id=tid).first() is None:
+        return jsonify({'error': 'User not found'}), 404
+    return jsonify({'error': insufficient}), 400
+
+# ─── WEIGHTED SAMPLING ──────────────────────────────────────────
+class WeightedSampler:
+    """Walker/Vose alias table: O(n) to compile, O(1) per draw with a single random() call.
+
+    Weights are percentages and must add up to 100.
+    """
+    def __init__(self, items, weights, total=100.0):
+        if len(items) != len(weights) or not items:
+            raise ValueError('sampler needs one weight per item')
+        if any(w < 0 for w in weights) or abs(sum(weights) - total) > 1e-6:
+            raise ValueError(f'weights must be non-negative and sum to {total}, got {sum(weights)}')
+        n = len(items)
+        scaled = [w * n / total for w in weights]
+        prob, alias = [1.0] * n, list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            prob[s], alias[s] = scaled[s], l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        self.items, self.prob, self.alias, self.n = list(items), prob, alias, n
+
+    def draw(self):
+        u = random.random() * self.n
+        i = int(u)
+        return self.items[i] if u - i < self.prob[i] else self.items[self.alias[i]]
+
+    def draw_many(self, k):
+        return [self.draw() for _ in range(k)]
+
+# ─── BACKGROUND THREADS ─────────────────────────────────────────
+# The Rolls clock, the notification outbox, the stats reconcile and the
+# write-behind flushers each run as one daemon thread per process, started by
+# start_background().
+background_threads = {}  # name -> threading.Thread
+
+def start_periodic(name, step, interval, final_step=False):
+    """Run `step()` in an app context every `interval` seconds on a daemon thread; once per name.
+
+    Errors are logged and the loop goes on. `final_step` runs it once more at exit, for buffers.
+    """
+    if name in background_threads:
+        return background_threads[name]
+
+    def run_step():
+        with app.app_context():
+            step()
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                run_step()
+            except Exception:
+                app.logger.exception('%s failed', name)
+                time.sleep(1)  # don't spin on a lasting failure
+
+    thread = background_threads[name] = threading.Thread(target=loop, name=name, daemon=True)
+    thread.start()
+    if final_step:
+        atexit.register(run_step)
+    return thread
+
 # ─── ROLLS GAME SHARED STATE ────────────────────────────────────
 # 100 chips: 49 red, 49 blue, 2 green
-rolls_game_state = {
-    'bets': {},           # user_id -> {'color': str, 'amount': float}
-    'countdown': 10,
-    'last_result': None,  # 'red'|'blue'|'green'
-    'history': [],        # last 20 results
-    'last_spin_time': time.time()
-}
+ROLLS_ROUND_SECONDS = 10
+ROLLS_BETTING_SECONDS = 9   # bets close 1s before the spin
+ROLLS_HISTORY_SIZE = 100
+
+try:
+    import fcntl
+except ImportError:  # Windows dev boxes: single process, no cross-worker leadership needed
+    fcntl = None
+
+_sqlite_local = threading.local()
+
+def sqlite_wal_connection(path):
+    """This thread's autocommit connection to a host-wide WAL-mode SQLite file, reopened after a fork"""
+    if getattr(_sqlite_local, 'pid', None) != os.getpid():
+        _sqlite_local.conns, _sqlite_local.pid = {}, os.getpid()
+    conn = _sqlite_local.conns.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _sqlite_local.conns[path] = conn
+    return conn
+
+def store_from_url(url, memory_cls, sqlite_cls, default_file):
+    """A shared-state backend from its env setting: 'memory', 'sqlite' (instance/`default_file`) or
+    'sqlite:////abs/path.db'"""
+    if url == 'memory':
+        return memory_cls()
+    if url == 'sqlite':
+        os.makedirs(app.instance_path, exist_ok=True)
+        return sqlite_cls(os.path.join(app.instance_path, default_file))
+    if url.startswith('sqlite:///'):
+        return sqlite_cls(url[len('sqlite:///'):])
+    raise ValueError(f'Unknown store URL {url!r}; expected memory, sqlite or sqlite:////path.db')
+
+class RollsStore(ABC):
+    """Round state shared by the bet endpoint, the state endpoint and the round scheduler.
+
+    Bets are keyed by str(telegram_id) -> {'color': str, 'amount': nano-TON, 'placed_at': ms}; the
+    published side holds last_result, history (newest first), last_payouts and last_spin_time.
+    """
+    @abstractmethod
+    def place_bet(self, user_id, color, amount):
+        """Record this user's bet for the coming spin; False if one is already pending"""
+
+    @abstractmethod
+    def has_bet(self, user_id):
+        """True while this user has a bet that hasn't been cleared"""
+
+    @abstractmethod
+    def pending_bets(self):
+        """Every bet not cleared yet, settled or not"""
+
+    @abstractmethod
+    def clear_bets(self, until):
+        """Drop bets placed at or before `until` (ms), once their payout has committed"""
+
+    @abstractmethod
+    def publish(self, result, payouts, spin_time):
+        """Publish a settled round"""
+
+    @abstractmethod
+    def set_spin_time(self, spin_time):
+        """Restart the round clock at `spin_time`"""
+
+    @abstractmethod
+    def last_spin_time(self):
+        """When the current round started"""
+
+    @abstractmethod
+    def snapshot(self):
+        """The published side as a dict"""
+
+    def acquire_leadership(self):
+        """True if this process may run the round clock"""
+        return True
+
+class MemoryRollsStore(RollsStore):
+    """In-process backend — only correct with a single worker process"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bets = {}
+        self._state = {'last_result': None, 'history': [], 'last_payouts': {}, 'last_spin_time': time.time()}
+
+    def place_bet(self, user_id, color, amount):
+        with self._lock:
+            if str(user_id) in self._bets:
+                return False
+            self._bets[str(user_id)] = {'color': color, 'amount': amount, 'placed_at': int(time.time() * 1000)}
+            return True
+
+    def has_bet(self, user_id):
+        return str(user_id) in self._bets
+
+    def pending_bets(self):
+        with self._lock:
+            return dict(self._bets)
+
+    def clear_bets(self, until):
+        with self._lock:
+            self._bets = {uid: bet for uid, bet in self._bets.items() if bet['placed_at'] > until}
+
+    def publish(self, result, payouts, spin_time):
+        with self._lock:
+            self._state = {
+                'last_result': result,
+                'history': ([result] + self._state['history'])[:ROLLS_HISTORY_SIZE],
+                'last_payouts': payouts,
+                'last_spin_time': spin_time,
+            }
+
+    def set_spin_time(self, spin_time):
+        with self._lock:
+            self._state = dict(self._state, last_spin_time=spin_time)
+
+    def last_spin_time(self):
+        return self._state['last_spin_time']
+
+    def snapshot(self):
+        return self._state
+
+class SQLiteRollsStore(RollsStore):
+    """Host-wide backend: a WAL-mode SQLite file every gunicorn worker opens.
+
+    Each write is a single autocommitted statement, so concurrent bets never
+    block each other for longer than one row upsert. The round clock is owned by
+    whichever process holds an flock on the sibling .lock file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock_file = None
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS rolls_bet (user_id TEXT PRIMARY KEY, color TEXT NOT NULL, amount NOT NULL, "
+                     "placed_at INTEGER NOT NULL DEFAULT 0)")
+        if 'placed_at' not in {row[1] for row in conn.execute("PRAGMA table_info(rolls_bet)")}:
+            conn.execute("ALTER TABLE rolls_bet ADD COLUMN placed_at INTEGER NOT NULL DEFAULT 0")
+        conn.execute("CREATE TABLE IF NOT EXISTS rolls_round (id INTEGER PRIMARY KEY CHECK (id = 1), "
+                     "last_spin_time REAL NOT NULL, last_result TEXT, history TEXT NOT NULL, last_payouts TEXT NOT NULL)")
+        conn.execute("INSERT OR IGNORE INTO rolls_round VALUES (1, ?, NULL, '[]', '{}')", (time.time(),))
+
+    def _conn(self):
+        return sqlite_wal_connection(self.path)
+
+    def place_bet(self, user_id, color, amount):
+        return self._conn().execute(
+            "INSERT INTO rolls_bet VALUES (?, ?, ?, ?) ON CONFLICT(user_id) DO NOTHING",
+            (str(user_id), color, amount, int(time.time() * 1000))).rowcount == 1
+
+    def has_bet(self, user_id):
+        return self._conn().execute("SELECT 1 FROM rolls_bet WHERE user_id = ?", (str(user_id),)).fetchone() is not None
+
+    def pending_bets(self):
+        rows = self._conn().execute("SELECT user_id, color, amount, placed_at FROM rolls_bet").fetchall()
+        return {uid: {'color': color, 'amount': amount, 'placed_at': placed_at} for uid, color, amount, placed_at in rows}
+
+    def clear_bets(self, until):
+        self._conn().execute("DELETE FROM rolls_bet WHERE placed_at <= ?", (until,))
+
+    def publish(self, result, payouts, spin_time):
+        history = ([result] + self.snapshot()['history'])[:ROLLS_HISTORY_SIZE]
+        self._conn().execute(
+            "UPDATE rolls_round SET last_spin_time = ?, last_result = ?, history = ?, last_payouts = ? WHERE id = 1",
+            (spin_time, result, json.dumps(history), json.dumps(payouts)))
+
+    def set_spin_time(self, spin_time):
+        self._conn().execute("UPDATE rolls_round SET last_spin_time = ? WHERE id = 1", (spin_time,))
+
+    def last_spin_time(self):
+        return self._conn().execute("SELECT last_spin_time FROM rolls_round WHERE id = 1").fetchone()[0]
+
+    def snapshot(self):
+        spin_time, result, history, payouts = self._conn().execute(
+            "SELECT last_spin_time, last_result, history, last_payouts FROM rolls_round WHERE id = 1").fetchone()
+        return {'last_result': result, 'history': json.loads(history),
+                'last_payouts': json.loads(payouts), 'last_spin_time': spin_time}
+
+    def acquire_leadership(self):
+        if fcntl is None or self._lock_file is not None:
+            return True
+        f = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._lock_file = f  # held for the life of the process
+        return True
+
+rolls_store = store_from_url(os.environ.get('ROLLS_STORE', 'sqlite'), MemoryRollsStore, SQLiteRollsStore, 'rolls_state.db')
+
+ROLLS_SAMPLER = WeightedSampler(['red', 'blue', 'green'], [49, 49, 2])
 
 def generate_rolls_result():
     """49 red, 49 blue, 2 green out of 100"""
-    chips = ['red']*49 + ['blue']*49 + ['green']*2
-    return random.choice(chips)
+    return ROLLS_SAMPLER.draw()
+
+def settle_rolls_bets(bets, result, until):
+    """Pay out a round in bulk: one select of the bettors, one update per outcome, one history insert.
+
+    Commits the payouts together with `until`, the newest placed_at they cover.
+    """
+    mult = 10 if result == 'green' else 2
+    known = {tid for (tid,) in db.session.query(User.telegram_id).filter(User.telegram_id.in_([int(u) for u in bets]))}
+    mark_user_changed(*known)
+
+    payouts, winners, losers, history = {}, [], [], []
+    for uid_str, bet in bets.items():
+        uid = int(uid_str)
+        if uid not in known:
+            continue
+        if bet['color'] == result:
+            winnings = bet['amount'] * mult
+            winners.append({'tid': uid, 'winnings': winnings})
+            payouts[uid_str] = {'won': True, 'amount': from_nano(winnings), 'mult': mult}
+            history.append({'user_id': uid, 'game_type': 'rolls', 'stake': bet['amount'],
+                            'result': winnings - bet['amount'], 'multiplier': mult})
+        else:
+            losers.append(uid)
+            payouts[uid_str] = {'won': False, 'amount': 0, 'mult': 0}
+            history.append({'user_id': uid, 'game_type': 'rolls', 'stake': bet['amount'],
+                            'result': -bet['amount'], 'multiplier': 0})
+
+    users = User.__table__
+    if winners:
+        db.session.execute(
+            users.update().where(users.c.telegram_id == db.bindparam('tid'))
+                 .values(balance=users.c.balance + db.bindparam('winnings'), games_played=users.c.games_played + 1),
+            winners)
+    if losers:
+        db.session.execute(users.update().where(users.c.telegram_id.in_(losers))
+                                .values(games_played=users.c.games_played + 1))
+    if winners:
+        db.session.execute(db.insert(LedgerEntry), [
+            {'user_id': w['tid'], 'account': 'main', 'delta': w['winnings'], 'reason': 'rolls_win'} for w in winners])
+    if history:
+        db.session.execute(db.insert(GameHistory), history)
+    db.session.merge(RollsSettlement(id=1, settled_until=until))
+    db.session.commit()
+    return payouts
+
+def resolve_rolls_round(spin_time):
+    """Spin the wheel, settle the round's bets and publish the result.
+
+    Bets leave the store only after their payout commits. If the process dies in
+    between, the next round skips them by the committed settled_until.
+    """
+    cutoff = int(time.time() * 1000)
+    settled = db.session.query(RollsSettlement.settled_until).filter_by(id=1).scalar()
+    settled = -1 if settled is None else settled
+    bets = {uid: bet for uid, bet in rolls_store.pending_bets().items() if settled < bet['placed_at'] <= cutoff}
+    result = generate_rolls_result()
+    started = time.perf_counter()
+    try:
+        payouts = settle_rolls_bets(bets, result, cutoff) if bets else {}
+    except Exception:
+        db.session.rollback()  # the stakes stay in the store and ride on the next spin
+        raise
+    rolls_store.clear_bets(cutoff if bets else settled)
+    elapsed = time.perf_counter() - started
+    rolls_store.publish(result, payouts, spin_time)
+
+    metrics.observe('rolls_settlement_seconds', (), elapsed)
+    metrics.inc('rolls_settled_bets_total', (), len(bets))
+    if elapsed > ROLLS_ROUND_SECONDS - ROLLS_BETTING_SECONDS:
+        app.logger.warning('Rolls round settled %d bets in %.1f ms', len(bets), elapsed * 1000)
+
+def run_due_rolls_round():
+    """Wait for the next spin and settle it if this process leads the round clock"""
+    state = rolls_store.snapshot()
+    refresh_rolls_feed(state)
+    spin_time = state['last_spin_time'] + ROLLS_ROUND_SECONDS
+    delay = spin_time - time.time()
+    if delay > 0:
+        time.sleep(delay)
+        return
+    if not rolls_store.acquire_leadership():
+        time.sleep(0.5)
+        return
+    # After a long stall (suspended process, restart) restart the clock instead of replaying rounds
+    if -delay > ROLLS_ROUND_SECONDS:
+        spin_time = time.time()
+    try:
+        resolve_rolls_round(spin_time)
+    except Exception:
+        app.logger.exception('Rolls round settlement failed')
+        rolls_store.set_spin_time(spin_time)
+
+# ─── ROLLS PUSH FEED ─────────────────────────────────────────────
+# Each worker's scheduler thread copies every published round into this feed once;
+# /api/rolls/stream subscribers block on the condition instead of polling the store.
+ROLLS_STREAM_MAX_SECONDS = 300  # EventSource reconnects on its own; bounds how long a worker thread is held
+# Each open stream holds a gthread thread; past this many per worker new ones get
+# 503 and the client polls, so streams can't take every thread from other requests.
+ROLLS_STREAM_MAX_PER_WORKER = int(os.environ.get('ROLLS_STREAM_MAX_PER_WORKER', 16))
+
+rolls_feed = {'version': 0, 'state': None}
+rolls_feed_cond = threading.Condition()
+rolls_feed_listeners = []  # called (from the publishing thread) after each new round, e.g. the ASGI event loop
+rolls_stream_slots = threading.BoundedSemaphore(ROLLS_STREAM_MAX_PER_WORKER)
+
+def refresh_rolls_feed(state):
+    with rolls_feed_cond:
+        current = rolls_feed['state']
+        if current is not None and current['last_spin_time'] == state['last_spin_time']:
+            return
+        rolls_feed['state'] = state
+        rolls_feed['version'] += 1
+        rolls_feed_cond.notify_all()
+    for listener in rolls_feed_listeners:
+        listener()
+
+def rolls_public_state(state):
+    history = state['history'][:20]
+    return {
+        'countdown': round(max(0, ROLLS_ROUND_SECONDS - (time.time() - state['last_spin_time'])), 2),
+        'last_result': state['last_result'],
+        'history': history,
+        'red_count': history.count('red'),
+        'blue_count': history.count('blue'),
+        'green_count': history.count('green'),
+    }
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def rolls_stream_event(uid, version, latest, state):
+    """The SSE event for a /api/rolls/stream subscriber that last saw `version`; returns (event, version)"""
+    public = rolls_public_state(state)
+    if latest != version:
+        # A subscriber joining mid-round gets the board but not a stale payout
+        payout = state['last_payouts'].get(uid) if version is not None else None
+        return sse_event('round', dict(public, payout=payout)), latest
+    return sse_event('tick', {'countdown': public['countdown']}), version
+
+def start_rolls_scheduler():
+    """Owns the Rolls round clock: resolves every round on time, independent of client traffic.
+
+    Runs in every worker, but only the store's leader settles rounds; the others
+    stand by and take over if the leader process goes away.
+    """
+    return start_periodic('rolls-scheduler', run_due_rolls_round, 0)
 
 # ─── GIFT UPGRADE (ROULETTE) LOGIC ─────────────────────────────
 def calculate_win_chance(multiplier):
     """Lower multiplier = higher chance. 1.3x -> ~76%, 20x -> ~5%"""
     return min(0.95, max(0.05, 1.0 / multiplier))
 
+@lru_cache(maxsize=64)
+def gift_upgrade_sampler(multiplier):
+    win = calculate_win_chance(multiplier) * 100
+    return WeightedSampler([True, False], [win, 100 - win])
+
 # ─── MUTANTS CASE REWARDS ─────────────────────────────────────
 REGULAR_CASE_REWARDS = [
     {"name": "Jolly Chimp", "image": "🐒", "chance": 5.36, "type": "nft", "sell_price": 0.5},
@@ -119,45 +784,1305 @@ FREE_CASE_NFT_DISPLAY = [
     {"name": "Desk Calendar", "chance": 0.3},
 ]
 
-def spin_case(case_type):
-    if case_type == 'free':
-        return FREE_CASE_REWARD
-    rewards = REGULAR_CASE_REWARDS if case_type == 'regular' else SNOOP_CASE_REWARDS
-    roll = random.uniform(0, 100)
-    cumulative = 0
+# Reward tables can be overridden without a restart: point REWARD_TABLES_FILE at a JSON
+# file {"regular": [...], "snoop": [...]} with the same entries as above. Every worker
+# notices a changed mtime within REWARD_TABLES_CHECK_SECONDS; an invalid file is
+# logged and the tables already live stay in use.
+REWARD_TABLES_FILE = os.environ.get('REWARD_TABLES_FILE')
+REWARD_TABLES_CHECK_SECONDS = 5
+MAX_BATCH_SPINS = 100  # per request, for both Gift Upgrade and cases
+
+def batch_count(data):
+    """A batch request's `count`, or None unless it's a whole number in 1..MAX_BATCH_SPINS"""
+    count = data.get('count', 1)
+    if isinstance(count, (bool, float)):
+        return None
+    try:
+        count = int(count)
+    except (TypeError, ValueError):
+        return None
+    return count if 1 <= count <= MAX_BATCH_SPINS else None
+
+def compile_reward_table(rewards):
+    """Validate a case's rewards and build its sampler.
+
+    sell_price is display TON; 'value' is what the game actually pays, in nano-TON.
+    """
     for reward in rewards:
-        cumulative += reward['chance']
-        if roll <= cumulative:
-            return reward
-    return rewards[-1]
+        if reward.get('type') not in ('nft', 'ton', 'nothing') or not reward.get('name'):
+            raise ValueError(f'bad reward entry: {reward}')
+        reward['value'] = to_nano(reward['sell_price'])
+    return WeightedSampler(rewards, [r['chance'] for r in rewards])
+
+FREE_CASE_REWARD['value'] = to_nano(FREE_CASE_REWARD['sell_price'])
+case_samplers = {'regular': compile_reward_table(REGULAR_CASE_REWARDS),
+                 'snoop': compile_reward_table(SNOOP_CASE_REWARDS)}
+_reward_tables = {'mtime': None, 'checked': 0.0}
+
+def reload_reward_tables(force=False):
+    global case_samplers, gift_ids
+    if not REWARD_TABLES_FILE:
+        return
+    now = time.time()
+    if not force and now - _reward_tables['checked'] < REWARD_TABLES_CHECK_SECONDS:
+        return
+    _reward_tables['checked'] = now
+    try:
+        mtime = os.stat(REWARD_TABLES_FILE).st_mtime
+        if mtime == _reward_tables['mtime']:
+            return
+        _reward_tables['mtime'] = mtime  # a broken file is reported once, not on every check
+        with open(REWARD_TABLES_FILE, encoding='utf-8') as f:
+            tables = json.load(f)
+        unknown = set(tables) - set(case_samplers)
+        if unknown:
+            raise ValueError(f'unknown case types {sorted(unknown)}')
+        samplers = {case: compile_reward_table(rewards) for case, rewards in tables.items()}
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        app.logger.error('Reward tables in %s not loaded: %s', REWARD_TABLES_FILE, e)
+        return
+    case_samplers = dict(case_samplers, **samplers)  # swap in one assignment
+    gift_ids = {}  # prices or images may have changed: resync the catalog on the next win
+    app.logger.info('Reward tables loaded from %s: %s', REWARD_TABLES_FILE, ', '.join(sorted(samplers)))
+
+reload_reward_tables(force=True)
+
+# ─── INVENTORY ──────────────────────────────────────────────────
+gift_ids = {}  # gift name -> Gift.id, filled by sync_gift_catalog
+
+def sync_gift_catalog():
+    """Upsert every NFT in the live reward tables into the catalog and swap in a fresh gift_ids; caller commits"""
+    global gift_ids
+    nfts = {r['name']: r for sampler in case_samplers.values() for r in sampler.items if r['type'] == 'nft'}
+    if nfts:
+        stmt = dialect_insert(Gift).values([{'name': r['name'], 'image': r.get('image', '🎁'), 'sell_price': r['value']}
+                                            for r in nfts.values()])
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['name'], set_={'image': stmt.excluded.image, 'sell_price': stmt.excluded.sell_price}))
+    gift_ids = dict(db.session.query(Gift.name, Gift.id))  # readers keep the mapping they already hold
+    return gift_ids
+
+def add_to_inventory(tid, rewards, now):
+    """Count won NFT rewards into the user's stacks in one upsert; caller commits"""
+    counts = {}
+    for r in rewards:
+        counts[r['name']] = counts.get(r['name'], 0) + 1
+    ids = gift_ids
+    if any(name not in ids for name in counts):
+        ids = sync_gift_catalog()
+    stmt = dialect_insert(Inventory).values([{'user_id': tid, 'gift_id': ids[name], 'quantity': n, 'obtained_at': now}
+                                             for name, n in counts.items()])
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id', 'gift_id'],
+        set_={'quantity': Inventory.quantity + stmt.excluded.quantity, 'obtained_at': stmt.excluded.obtained_at}))
+
+def reward_json(reward):
+    return {k: v for k, v in reward.items() if k != 'value'}
+
+def spin_cases(case_type, count=1):
+    if case_type == 'free':
+        return [FREE_CASE_REWARD] * count
+    reload_reward_tables()
+    return case_samplers[case_type].draw_many(count)
+
+def spin_case(case_type):
+    return spin_cases(case_type)[0]
 
 # ─── HELPERS ────────────────────────────────────────────────────
 def get_or_create_user(telegram_id, first_name='', last_name='', username='', photo_url=''):
+    """Returns (user, changed); caller commits if changed. A returning user's last_online is buffered"""
     user = User.query.filter_by(telegram_id=telegram_id).first()
+    now = datetime.utcnow()
     if not user:
         user = User(telegram_id=telegram_id, first_name=first_name, last_name=last_name,
-                    username=username, photo_url=photo_url)
+                    username=username, photo_url=photo_url, last_online=now)
         db.session.add(user)
-        db.session.commit()
+        record_new_user(now)
+        return user, True
+    presence.touch(telegram_id, user.last_online, now)
+    changed = False
+    if first_name and first_name != user.first_name:
+        user.first_name, changed = first_name, True
+        mark_user_changed(user.ref_id)  # the name shows in the referrer's list
+    if photo_url and photo_url != user.photo_url:
+        user.photo_url, changed = photo_url, True
+    return user, changed
+
+# ─── COMMIT AUDIT ───────────────────────────────────────────────
+# Every API call is one unit of work: handlers flush when they need an id and
+# commit once at the end. On SQLite each commit is an fsync, so count them.
+MAX_COMMITS_PER_REQUEST = 1
+
+@app.before_request
+def reset_commit_count():
+    g.db_commits = 0
+
+@event.listens_for(Engine, 'commit')
+def count_commit(conn):
+    if has_request_context():
+        g.db_commits = g.get('db_commits', 0) + 1
+
+@app.after_request
+def audit_commits(response):
+    commits = g.get('db_commits', 0)
+    if app.config['COMMIT_AUDIT']:
+        response.headers['X-DB-Commits'] = str(commits)
+    if commits > MAX_COMMITS_PER_REQUEST:
+        app.logger.warning('%s %s committed %d times', request.method, request.path, commits)
+    return response
+
+# ─── METRICS & PROFILING ────────────────────────────────────────
+# Request hooks and engine events add up per-request timings in `g`; after the
+# response they go into this worker's registry under one lock. Every few seconds
+# the worker drains its registry into the running totals in METRICS_STORE, which
+# all workers share, and /metrics renders those totals in Prometheus text format,
+# so whichever worker answers a scrape reports the whole host and counters never
+# go backwards. Sampling profiles of single requests are switched on at runtime
+# from the admin API (a fraction of requests, or those sent with `X-Profile: 1`);
+# the switch and the recent profiles live in the same store.
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+METRICS_FLUSH_SECONDS = 5
+PROFILE_INTERVAL = 0.002
+PROFILE_KEEP = 20       # most recent profiles kept across workers
+PROFILE_TOP_STACKS = 40
+PROFILING_REFRESH_SECONDS = 1  # how stale a worker's copy of the profiler switch may get
+
+class Metrics:
+    """Counters and histograms keyed by (name, labels); labels is a tuple of (key, value) pairs"""
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}  # (name, labels) -> [count per bucket..., +Inf count, sum]
+
+    def _inc(self, name, labels, value):
+        self.counters[name, labels] = self.counters.get((name, labels), 0) + value
+
+    def _observe(self, name, labels, seconds):
+        hist = self.histograms.get((name, labels))
+        if hist is None:
+            hist = self.histograms[name, labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                hist[i] += 1
+        hist[-2] += 1
+        hist[-1] += seconds
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            self._inc(name, labels, value)
+
+    def observe(self, name, labels, seconds):
+        with self.lock:
+            self._observe(name, labels, seconds)
+
+    def drain(self):
+        """Everything recorded since the last drain, as a JSON-able snapshot; the registry starts over"""
+        with self.lock:
+            counters, histograms = self.counters, self.histograms
+            self.counters, self.histograms = {}, {}
+        return {'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+                'histograms': [[name, labels, hist] for (name, labels), hist in histograms.items()]}
+
+    def merge(self, snapshot):
+        """Add a drained snapshot into this registry"""
+        with self.lock:
+            for name, labels, value in snapshot['counters']:
+                self._inc(name, tuple(map(tuple, labels)), value)
+            for name, labels, hist in snapshot['histograms']:
+                total = self.histograms.setdefault((name, tuple(map(tuple, labels))),
+                                                   [0] * (len(self.buckets) + 1) + [0.0])
+                for i, value in enumerate(hist):
+                    total[i] += value
+
+    def record_request(self, endpoint, method, status, seconds, queries, query_seconds, commits, json_seconds):
+        labels = (('endpoint', endpoint),)
+        with self.lock:
+            self._inc('http_requests_total', labels + (('method', method), ('status', str(status))), 1)
+            self._observe('http_request_duration_seconds', labels, seconds)
+            self._inc('db_queries_total', labels, queries)
+            self._inc('db_query_seconds_total', labels, query_seconds)
+            self._inc('db_commits_total', labels, commits)
+            self._inc('json_encode_seconds_total', labels, json_seconds)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = labels + extra
+        if not pairs:
+            return ''
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(hist)) for key, hist in self.histograms.items())
+        lines, typed = [], set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), hist in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            for bound, count in zip(self.buckets, hist):
+                lines.append(f'{name}_bucket{self._labels(labels, (("le", bound),))} {count}')
+            lines.append(f'{name}_bucket{self._labels(labels, (("le", "+Inf"),))} {hist[-2]}')
+            lines.append(f'{name}_sum{self._labels(labels)} {hist[-1]}')
+            lines.append(f'{name}_count{self._labels(labels)} {hist[-2]}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+class MetricsStore(ABC):
+    """Running metric totals of every worker, plus the profiler switch and recent profiles"""
+    @abstractmethod
+    def add(self, snapshot):
+        """Add a worker's drained snapshot to the totals"""
+
+    @abstractmethod
+    def totals(self):
+        """A Metrics registry holding the totals"""
+
+    @abstractmethod
+    def profiling(self):
+        """{'enabled': bool, 'sample_rate': float}"""
+
+    @abstractmethod
+    def set_profiling(self, enabled, sample_rate):
+        """Switch the sampler for every worker"""
+
+    @abstractmethod
+    def add_profile(self, profile):
+        """Keep a profile, dropping all but the last PROFILE_KEEP"""
+
+    @abstractmethod
+    def profiles(self):
+        """The last PROFILE_KEEP profiles, oldest first"""
+
+class MemoryMetricsStore(MetricsStore):
+    """In-process backend — only correct with a single worker process"""
+    def __init__(self):
+        self.total = Metrics()
+        self.settings = {'enabled': False, 'sample_rate': 0.0}
+        self.recent = deque(maxlen=PROFILE_KEEP)
+
+    def add(self, snapshot):
+        self.total.merge(snapshot)
+
+    def totals(self):
+        return self.total
+
+    def profiling(self):
+        return dict(self.settings)
+
+    def set_profiling(self, enabled, sample_rate):
+        self.settings = {'enabled': enabled, 'sample_rate': sample_rate}
+
+    def add_profile(self, profile):
+        self.recent.append(profile)
+
+    def profiles(self):
+        return list(self.recent)
+
+class SQLiteMetricsStore(MetricsStore):
+    """Host-wide backend in a WAL-mode SQLite file, shared by every worker"""
+    def __init__(self, path):
+        self.path = path
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS metric_totals (id INTEGER PRIMARY KEY CHECK (id = 1), body TEXT NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS profiling (id INTEGER PRIMARY KEY CHECK (id = 1), "
+                     "enabled INTEGER NOT NULL, sample_rate REAL NOT NULL)")
+        conn.execute("INSERT OR IGNORE INTO profiling VALUES (1, 0, 0.0)")
+        conn.execute("CREATE TABLE IF NOT EXISTS profile (id INTEGER PRIMARY KEY AUTOINCREMENT, body TEXT NOT NULL)")
+
+    def _conn(self):
+        return sqlite_wal_connection(self.path)
+
+    @staticmethod
+    def _load(conn):
+        total = Metrics()
+        row = conn.execute("SELECT body FROM metric_totals WHERE id = 1").fetchone()
+        if row is not None:
+            total.merge(json.loads(row[0]))
+        return total
+
+    def add(self, snapshot):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")  # read, add and write back while holding the write lock
+        try:
+            total = self._load(conn)
+            total.merge(snapshot)
+            conn.execute("INSERT INTO metric_totals VALUES (1, ?) ON CONFLICT (id) DO UPDATE SET body = excluded.body",
+                         (json.dumps(total.drain()),))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def totals(self):
+        return self._load(self._conn())
+
+    def profiling(self):
+        enabled, rate = self._conn().execute("SELECT enabled, sample_rate FROM profiling WHERE id = 1").fetchone()
+        return {'enabled': bool(enabled), 'sample_rate': rate}
+
+    def set_profiling(self, enabled, sample_rate):
+        self._conn().execute("UPDATE profiling SET enabled = ?, sample_rate = ? WHERE id = 1", (int(enabled), sample_rate))
+
+    def add_profile(self, profile):
+        conn = self._conn()
+        profile_id = conn.execute("INSERT INTO profile (body) VALUES (?)", (json.dumps(profile),)).lastrowid
+        conn.execute("DELETE FROM profile WHERE id <= ?", (profile_id - PROFILE_KEEP,))
+
+    def profiles(self):
+        rows = self._conn().execute("SELECT body FROM profile ORDER BY id DESC LIMIT ?", (PROFILE_KEEP,)).fetchall()
+        return [json.loads(body) for (body,) in reversed(rows)]
+
+metrics_store = store_from_url(os.environ.get('METRICS_STORE', 'sqlite'), MemoryMetricsStore, SQLiteMetricsStore, 'metrics.db')
+metrics_flushed_at = 0.0
+
+def flush_metrics(force=False):
+    """Drain this worker's registry into the shared totals, at most every METRICS_FLUSH_SECONDS unless forced"""
+    global metrics_flushed_at
+    if not force and time.monotonic() - metrics_flushed_at < METRICS_FLUSH_SECONDS:
+        return
+    metrics_flushed_at = time.monotonic()
+    snapshot = metrics.drain()
+    try:
+        metrics_store.add(snapshot)
+    except sqlite3.Error:
+        metrics.merge(snapshot)  # keep them for the next flush
+        app.logger.exception('Metrics flush failed')
+
+atexit.register(flush_metrics, True)
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """jsonify() with its encoding time added to the request's metrics"""
+    def dumps(self, obj, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            if has_request_context():
+                g.json_seconds = g.get('json_seconds', 0.0) + time.perf_counter() - start
+
+app.json = TimedJSONProvider(app)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    if context is None:
+        return
+    elapsed = time.perf_counter() - context.query_started
+    if has_request_context():
+        g.db_queries = g.get('db_queries', 0) + 1
+        g.db_query_seconds = g.get('db_query_seconds', 0.0) + elapsed
     else:
-        user.last_online = datetime.utcnow()
-        if first_name: user.first_name = first_name
-        if photo_url: user.photo_url = photo_url
-        db.session.commit()
+        metrics.observe('background_db_query_seconds', (), elapsed)
+
+class StackSampler:
+    """Samples one thread's Python stack from a helper thread; counts collapsed 'file:function;...' stacks"""
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id, self.interval = thread_id, interval
+        self.stacks = Counter()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+        return self.stacks
+
+profiling = {'settings': {'enabled': False, 'sample_rate': 0.0}, 'read_at': 0.0}  # this worker's copy
+
+def profiling_settings():
+    if time.monotonic() - profiling['read_at'] > PROFILING_REFRESH_SECONDS:
+        profiling.update(settings=metrics_store.profiling(), read_at=time.monotonic())
+    return profiling['settings']
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    settings = profiling_settings()
+    if settings['enabled'] and (request.headers.get('X-Profile') == '1' or random.random() < settings['sample_rate']):
+        g.sampler = StackSampler(threading.get_ident()).start()
+
+@app.after_request
+def record_request_metrics(response):
+    elapsed = time.perf_counter() - g.get('request_started', time.perf_counter())
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.record_request(endpoint, request.method, response.status_code, elapsed, g.get('db_queries', 0),
+                           g.get('db_query_seconds', 0.0), g.get('db_commits', 0), g.get('json_seconds', 0.0))
+    sampler = g.pop('sampler', None)
+    if sampler is not None:
+        stacks = sampler.stop()
+        metrics_store.add_profile({
+            'endpoint': endpoint, 'method': request.method, 'status': response.status_code,
+            'at': datetime.utcnow().isoformat(timespec='seconds'), 'duration_ms': round(elapsed * 1000, 3),
+            'db_queries': g.get('db_queries', 0), 'db_ms': round(g.get('db_query_seconds', 0.0) * 1000, 3),
+            'samples': sum(stacks.values()),
+            'stacks': [f'{stack} {n}' for stack, n in stacks.most_common(PROFILE_TOP_STACKS)],
+        })
+    flush_metrics()
+    return response
+
+# ─── TELEGRAM NOTIFICATIONS ─────────────────────────────────────
+# Handlers only add a Notification row (committed with their own change); a
+# background dispatcher delivers the outbox over one pooled HTTP session, so a
+# slow Telegram API never holds up a request.
+NOTIFY_POLL_SECONDS = 1.0
+NOTIFY_BATCH_SIZE = 50
+NOTIFY_LEASE_SECONDS = 60       # a claimed batch is retried if its dispatcher dies
+NOTIFY_MAX_ATTEMPTS = 8
+NOTIFY_MAX_BACKOFF_SECONDS = 3600
+NOTIFY_RETENTION_DAYS = 7
+TELEGRAM_MAX_TEXT = 4096
+TELEGRAM_GLOBAL_INTERVAL = 1 / 30  # Bot API: ~30 messages/s overall
+TELEGRAM_CHAT_INTERVAL = 1.0       # and about one per second to the same chat
+
+def send_telegram_message(chat_id, text, session=None):
+    """Queue a message for the dispatcher; caller commits"""
+    (session or db.session).add(Notification(chat_id=str(chat_id), text=text))
+
+def notify_admin(text, session=None):
+    send_telegram_message(ADMIN_CHAT_ID, text, session)
+
+class TelegramSendError(Exception):
+    def __init__(self, message, retry_after=None, permanent=False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.permanent = permanent
+
+class TelegramDispatcher:
+    def __init__(self, api_url=None, token=None):
+        self.api_url = api_url or TELEGRAM_API_URL
+        self.token = token or BOT_TOKEN
+        self.http = requests.Session()
+        self.http.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.http.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.last_sent = 0.0
+        self.last_sent_to = {}  # chat_id -> time.monotonic() of the last message
+        self.paused_until = 0.0  # set from a 429's retry_after
+        self.cleaned_at = 0.0
+
+    def send_delay(self, chat_id):
+        """Seconds to wait before the next sendMessage to `chat_id` stays within Telegram's limits"""
+        now = time.monotonic()
+        return max(self.paused_until - now, self.last_sent + TELEGRAM_GLOBAL_INTERVAL - now,
+                   self.last_sent_to.get(chat_id, 0.0) + TELEGRAM_CHAT_INTERVAL - now)
+
+    def check_response(self, status_code, body):
+        """Raise TelegramSendError unless Telegram accepted the message"""
+        if body.get('ok'):
+            return
+        retry_after = (body.get('parameters') or {}).get('retry_after')
+        if status_code == 429 and retry_after:
+            self.paused_until = time.monotonic() + retry_after
+        # 400/403: bad chat, blocked bot — retrying won't help
+        raise TelegramSendError(body.get('description', f'HTTP {status_code}'), retry_after,
+                                permanent=status_code in (400, 403))
+
+    def post(self, chat_id, text):
+        """One sendMessage call, paced to Telegram's limits"""
+        wait = self.send_delay(chat_id)
+        if wait > 0:
+            time.sleep(wait)
+        self.last_sent = self.last_sent_to[chat_id] = time.monotonic()
+        try:
+            resp = self.http.post(f'{self.api_url}/bot{self.token}/sendMessage',
+                                  json={'chat_id': chat_id, 'text': text, 'parse_mode': 'HTML'}, timeout=10)
+            body = resp.json()
+        except (requests.RequestException, ValueError) as e:
+            raise TelegramSendError(str(e))
+        finally:
+            metrics.observe('outbound_http_seconds', (('target', 'telegram'),), time.monotonic() - self.last_sent)
+        self.check_response(resp.status_code, body)
+
+    def claim(self, session):
+        """Lease a batch of due messages; the conditional UPDATE keeps two workers off the same rows"""
+        now = datetime.utcnow()
+        ids = [i for (i,) in session.query(Notification.id)
+               .filter(Notification.status == 'pending', Notification.next_attempt_at <= now)
+               .order_by(Notification.next_attempt_at).limit(NOTIFY_BATCH_SIZE)]
+        if not ids:
+            return []
+        rows = session.execute(
+            db.update(Notification)
+              .where(Notification.id.in_(ids), Notification.status == 'pending', Notification.next_attempt_at <= now)
+              .values(next_attempt_at=now + timedelta(seconds=NOTIFY_LEASE_SECONDS))
+              .returning(Notification.id, Notification.chat_id, Notification.text, Notification.attempts),
+            execution_options={'synchronize_session': False}).all()
+        session.commit()
+        return sorted(rows)
+
+    @staticmethod
+    def coalesce(rows):
+        """Group claimed rows per chat into as few messages as fit Telegram's length limit"""
+        batches = []
+        open_batch = {}
+        for row in rows:
+            batch = open_batch.get(row.chat_id)
+            if batch is None or len(batch['text']) + 2 + len(row.text) > TELEGRAM_MAX_TEXT:
+                batch = open_batch[row.chat_id] = {'chat_id': row.chat_id, 'text': row.text, 'rows': [row]}
+                batches.append(batch)
+            else:
+                batch['text'] += '\n\n' + row.text
+                batch['rows'].append(row)
+        return batches
+
+    def settle(self, session, batch, error=None):
+        """Mark a batch sent, or schedule its retry (or give up) after `error`"""
+        ids = [r.id for r in batch['rows']]
+        if error is None:
+            values = {'status': 'sent', 'sent_at': datetime.utcnow(), 'attempts': Notification.attempts + 1}
+        else:
+            attempts = max(r.attempts for r in batch['rows']) + 1
+            failed = error.permanent or attempts >= NOTIFY_MAX_ATTEMPTS
+            delay = error.retry_after or min(NOTIFY_MAX_BACKOFF_SECONDS, 5 * 2 ** attempts)
+            app.logger.warning('Telegram send to %s failed (attempt %d): %s', batch['chat_id'], attempts, error)
+            values = {'status': 'failed' if failed else 'pending', 'attempts': attempts, 'last_error': str(error)[:500],
+                      'next_attempt_at': datetime.utcnow() + timedelta(seconds=delay)}
+        session.execute(db.update(Notification).where(Notification.id.in_(ids)).values(**values),
+                        execution_options={'synchronize_session': False})
+        session.commit()
+
+    def cleanup_due(self):
+        if time.time() - self.cleaned_at > 3600:
+            self.cleaned_at = time.time()
+            return True
+        return False
+
+    def cleanup(self, session):
+        """Forget chats past their per-chat delay, and drop sent notifications past the retention window"""
+        idle = time.monotonic() - TELEGRAM_CHAT_INTERVAL
+        self.last_sent_to = {chat_id: at for chat_id, at in self.last_sent_to.items() if at > idle}
+        session.query(Notification).filter(
+            Notification.status == 'sent',
+            Notification.sent_at < datetime.utcnow() - timedelta(days=NOTIFY_RETENTION_DAYS)
+        ).delete(synchronize_session=False)
+        session.commit()
+
+    def run_once(self):
+        """Deliver one claimed batch; returns how many notifications were handled"""
+        rows = self.claim(db.session)
+        for batch in self.coalesce(rows):
+            try:
+                self.post(batch['chat_id'], batch['text'][:TELEGRAM_MAX_TEXT])
+            except TelegramSendError as e:
+                self.settle(db.session, batch, e)
+            else:
+                self.settle(db.session, batch)
+        if self.cleanup_due():
+            self.cleanup(db.session)
+        return len(rows)
+
+def start_notification_dispatcher():
+    dispatcher = TelegramDispatcher()
+
+    def dispatch():
+        while dispatcher.run_once() >= NOTIFY_BATCH_SIZE:  # a full batch: more are probably due
+            pass
+
+    return start_periodic('notification-dispatcher', dispatch, NOTIFY_POLL_SECONDS)
+
+# ─── LEADERBOARD CACHE ──────────────────────────────────────────
+LEADERBOARD_SIZE = 35
+LEADERBOARD_SLACK = 65        # extra rows kept so the board still fills up after re-ranking
+LEADERBOARD_RESYNC_SECONDS = 30  # picks up deposits and renames handled by other workers
+
+class LeaderboardCache:
+    """Top-K users by total_deposited, kept in memory next to the DB.
+
+    total_deposited only grows, so a user outside the cached top-K can enter it
+    only by beating its current minimum — deposits are applied incrementally and
+    the DB is read again only for a periodic resync.
+    """
+    def __init__(self, capacity=LEADERBOARD_SIZE + LEADERBOARD_SLACK):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.rows = {}        # telegram_id -> row dict
+        self.body = None      # rendered JSON for the public board
+        self.etag = None
+        self.synced_at = 0.0
+
+    @staticmethod
+    def row(user):
+        return {'telegram_id': user.telegram_id, 'name': user.first_name or 'User',
+                'username': user.username, 'photo_url': user.photo_url,
+                'total_deposited': user.total_deposited or 0}
+
+    def rebuild(self):
+        """Reload the top-K from the DB; needs an app context"""
+        users = (db.session.query(User.telegram_id, User.first_name, User.username,
+                                  User.photo_url, User.total_deposited)
+                 .order_by(User.total_deposited.desc()).limit(self.capacity).all())
+        with self.lock:
+            self.rows = {u.telegram_id: self.row(u) for u in users}
+            self.synced_at = time.time()
+            self._render()
+
+    def record(self, user):
+        """Apply a committed change to a user's total or profile; no DB access"""
+        row = self.row(user)
+        with self.lock:
+            if row['telegram_id'] not in self.rows:
+                if len(self.rows) >= self.capacity and \
+                        row['total_deposited'] <= min(r['total_deposited'] for r in self.rows.values()):
+                    return
+            elif self.rows[row['telegram_id']] == row:
+                return
+            self.rows[row['telegram_id']] = row
+            while len(self.rows) > self.capacity:
+                lowest = min(self.rows.values(), key=lambda r: (r['total_deposited'], -r['telegram_id']))
+                del self.rows[lowest['telegram_id']]
+            self._render()
+
+    def _render(self):
+        ranked = sorted(self.rows.values(), key=lambda r: (-r['total_deposited'], r['telegram_id']))
+        board = [{'rank': i + 1, **r, 'total_deposited': from_nano(r['total_deposited'])}
+                 for i, r in enumerate(ranked[:LEADERBOARD_SIZE])]
+        self.body = json.dumps(board)
+        self.etag = hashlib.sha1(self.body.encode()).hexdigest()
+
+    def snapshot(self):
+        """(body, etag), resyncing from the DB when the copy is old"""
+        if time.time() - self.synced_at > LEADERBOARD_RESYNC_SECONDS:
+            self.rebuild()
+        return self.body, self.etag
+
+leaderboard_cache = LeaderboardCache()
+
+# ─── ADMIN STATS ────────────────────────────────────────────────
+# The dashboard reads counters kept up to date in the same transactions that
+# create users, record presence and credit deposits. Online counts come from a
+# histogram of last_online per minute: a user who comes back moves from their
+# old bucket to the current one, so summing the buckets inside a window counts
+# each user once. A periodic reconciliation recomputes everything from the real
+# tables and fixes drift (e.g. two concurrent opens by the same user).
+ONLINE_NOW_MINUTES = 5
+ONLINE_WINDOW_MINUTES = 24 * 60
+STATS_RECONCILE_SECONDS = 600
+EPOCH = datetime(1970, 1, 1)
+
+def epoch_minute(dt):
+    return int((dt - EPOCH).total_seconds() // 60)
+
+def dialect_insert(model, session=None):
+    """INSERT that supports on_conflict_do_update on both SQLite and PostgreSQL"""
+    dialect = (session or db.session).get_bind().dialect.name
+    return {'sqlite': sqlite_dialect.insert, 'postgresql': postgresql_dialect.insert}[dialect](model)
+
+def upsert_add(model, key, column, deltas, session=None):
+    """Add deltas ({key: delta}) to a counter column, creating missing rows"""
+    if not deltas:
+        return
+    stmt = dialect_insert(model, session).values([{key: k, column: d} for k, d in deltas.items()])
+    stmt = stmt.on_conflict_do_update(index_elements=[key],
+                                      set_={column: getattr(model, column) + stmt.excluded[column]})
+    (session or db.session).execute(stmt)
+
+def record_new_user(now):
+    upsert_add(StatCounter, 'name', 'value', {'users': 1})
+    upsert_add(OnlineBucket, 'minute', 'users', {epoch_minute(now): 1})
+
+def presence_deltas(moves, now):
+    """Bucket changes for a list of (old_last_online, new_last_online)"""
+    cutoff = epoch_minute(now) - ONLINE_WINDOW_MINUTES
+    deltas = {}
+    for old, new in moves:
+        old_b, new_b = epoch_minute(old) if old else None, epoch_minute(new)
+        if old_b == new_b:
+            continue
+        if old_b is not None and old_b >= cutoff:
+            deltas[old_b] = deltas.get(old_b, 0) - 1
+        deltas[new_b] = deltas.get(new_b, 0) + 1
+    return {b: d for b, d in deltas.items() if d}
+
+def record_presence(moves, now):
+    """Move users between online buckets"""
+    upsert_add(OnlineBucket, 'minute', 'users', presence_deltas(moves, now))
+
+def record_deposit(amount, session=None):
+    upsert_add(StatCounter, 'name', 'value', {'total_deposited': amount}, session)
+
+def read_stats(now=None):
+    now = now or datetime.utcnow()
+    minute = epoch_minute(now)
+    counters = dict(db.session.query(StatCounter.name, StatCounter.value))
+    buckets = db.session.query(OnlineBucket.minute, OnlineBucket.users).filter(
+        OnlineBucket.minute > minute - ONLINE_WINDOW_MINUTES).all()
+    buckets += presence.pending_deltas(now).items()  # this worker's sign-ins not flushed yet
+    return {
+        'total_users': counters.get('users', 0),
+        'online_24h': sum(n for _, n in buckets),
+        'online_now': sum(n for m, n in buckets if m > minute - ONLINE_NOW_MINUTES),
+        'total_deposited': counters.get('total_deposited', 0),
+    }
+
+def reconcile_stats(force=False):
+    """Recompute the counters from the real tables; one worker per interval does it"""
+    now = datetime.utcnow()
+    stamp = int(time.time())
+    without_statement_timeout(db.session.connection())  # full-table aggregates
+    if not force:
+        claimed = db.session.execute(
+            db.update(StatCounter).where(StatCounter.name == 'reconciled_at',
+                                         StatCounter.value <= stamp - STATS_RECONCILE_SECONDS)
+              .values(value=stamp), execution_options={'synchronize_session': False}).rowcount
+        if not claimed and db.session.get(StatCounter, 'reconciled_at') is not None:
+            db.session.rollback()
+            return False
+    before = read_stats(now)
+    cutoff = now - timedelta(minutes=ONLINE_WINDOW_MINUTES)
+    histogram = {}
+    for (seen,) in db.session.query(User.last_online).filter(User.last_online >= cutoff):
+        histogram[epoch_minute(seen)] = histogram.get(epoch_minute(seen), 0) + 1
+    totals = {'users': db.session.query(db.func.count(User.id)).scalar(),
+              'total_deposited': db.session.query(db.func.sum(User.total_deposited)).scalar() or 0,
+              'reconciled_at': stamp}
+    db.session.query(StatCounter).delete()
+    db.session.query(OnlineBucket).delete()
+    db.session.add_all(StatCounter(name=k, value=v) for k, v in totals.items())
+    db.session.add_all(OnlineBucket(minute=m, users=n) for m, n in histogram.items())
+    db.session.commit()
+    after = read_stats(now)
+    if before != after:
+        app.logger.info('Admin stats reconciled: %s -> %s', before, after)
+    return True
+
+def start_stats_reconciler():
+    return start_periodic('stats-reconciler', reconcile_stats, STATS_RECONCILE_SECONDS / 10)
+
+# ─── PRESENCE (write-behind last_online) ───────────────────────
+# Opening the app only touches this buffer; a background thread writes the
+# collected last_online values, and their online_bucket moves, in one
+# transaction every few seconds.
+PRESENCE_FLUSH_SECONDS = 5
+
+class PresenceBuffer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}  # telegram_id -> (last_online in the DB, last seen)
+
+    def touch(self, tid, stored, seen):
+        with self.lock:
+            self._merge(tid, stored, seen)
+
+    def _merge(self, tid, stored, seen):
+        if tid in self.pending:  # the first sighting knows what the DB holds
+            stored, seen = self.pending[tid][0], max(seen, self.pending[tid][1])
+        self.pending[tid] = (stored, seen)
+
+    def pending_deltas(self, now):
+        with self.lock:
+            moves = list(self.pending.values())
+        return presence_deltas(moves, now)
+
+    def flush(self):
+        """Write the buffer in one bulk UPDATE; needs an app context. Returns users written."""
+        with self.lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return 0
+        users = User.__table__
+        try:
+            db.session.execute(
+                users.update().where(users.c.telegram_id == db.bindparam('tid'),
+                                     users.c.last_online < db.bindparam('seen'))
+                     .values(last_online=db.bindparam('seen')),
+                [{'tid': tid, 'seen': seen} for tid, (_, seen) in batch.items()])
+            record_presence(batch.values(), datetime.utcnow())
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self.lock:  # keep them for the next flush
+                for tid, (stored, seen) in batch.items():
+                    self._merge(tid, stored, seen)
+            raise
+        return len(batch)
+
+presence = PresenceBuffer()
+
+def start_presence_flusher():
+    return start_periodic('presence-flusher', presence.flush, PRESENCE_FLUSH_SECONDS, final_step=True)
+
+# ─── PAGINATION ─────────────────────────────────────────────────
+# Per-user lists are paged newest-first on a key that never changes for a row:
+# (timestamp, id), or the id alone where the timestamp moves (inventory stacks).
+# The body stays a plain JSON array; X-Next-Cursor carries the opaque cursor for
+# the next page and is absent on the last one.
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(key):
+    text = '|'.join(v.isoformat() if isinstance(v, datetime) else str(v) for v in key)
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, key_cols):
+    """Cursor -> key values typed like `key_cols`; raises ValueError on anything we didn't issue"""
+    parts = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().split('|')
+    if len(parts) != len(key_cols):
+        raise ValueError(cursor)
+    return tuple(datetime.fromisoformat(p) if isinstance(c.type, db.DateTime) else int(p)
+                 for p, c in zip(parts, key_cols))
+
+def page_args():
+    """(limit, cursor) from the query string; raises ValueError on bad input"""
+    limit = min(max(int(request.args.get('limit', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    return limit, request.args.get('cursor')
+
+def keyset_page(stmt, *key_cols):
+    """Run one page of `stmt`, newest first on `key_cols`; returns (rows, next_cursor or None)"""
+    limit, cursor = page_args()
+    if cursor:
+        stmt = stmt.where(db.tuple_(*key_cols) < decode_cursor(cursor, key_cols))
+    rows = db.session.execute(stmt.order_by(*(c.desc() for c in key_cols)).limit(limit + 1)).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]._mapping
+    return rows, encode_cursor([last[c.key] for c in key_cols])
+
+def referee_page(tid):
+    """Newest-first page of the users `tid` referred; aggregates live on the referrer's row"""
+    return keyset_page(db.select(User.id, User.first_name, User.username, User.total_deposited, User.created_at)
+                         .where(User.ref_id == tid), User.created_at, User.id)
+
+def paged_response(items, next_cursor):
+    resp = jsonify(items)
+    if next_cursor:
+        resp.headers['X-Next-Cursor'] = next_cursor
+    return resp
+
+# ─── PER-USER RESPONSE CACHE ────────────────────────────────────
+# Read-mostly per-user views (balance, referrals, free case, mutants check) are
+# cached as rendered JSON. Code that changes a user's data calls
+# mark_user_changed(); the session drops those users' entries right after it
+# commits. Readers capture the user's generation before querying and a put()
+# after a newer invalidation is ignored, so a slow read can't re-cache data a
+# concurrent commit just replaced.
+USER_CACHE_TTL = 30
+USER_CACHE_MAX_ENTRIES = 20000
+USER_CACHE_VIEWS = ('balance', 'referrals', 'free_case', 'mutants_check')
+
+class UserCache(ABC):
+    @abstractmethod
+    def get(self, tid, view):
+        """(etag, body) or None"""
+
+    @abstractmethod
+    def generation(self, tid):
+        """Counter bumped by every invalidate() of this user"""
+
+    @abstractmethod
+    def put(self, tid, view, etag, body, generation):
+        """Store a view unless the user was invalidated after `generation` was read"""
+
+    @abstractmethod
+    def invalidate(self, tids):
+        """Drop these users' views and bump their generations"""
+
+class MemoryUserCache(UserCache):
+    """LRU + TTL dict; only correct with a single worker process"""
+    def __init__(self, max_entries=USER_CACHE_MAX_ENTRIES, ttl=USER_CACHE_TTL):
+        self.max_entries, self.ttl = max_entries, ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # (tid, view) -> (expires_at, etag, body), oldest use first
+        self.generations = {}
+
+    def get(self, tid, view):
+        with self.lock:
+            entry = self.entries.get((tid, view))
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[(tid, view)]
+                return None
+            self.entries.move_to_end((tid, view))
+            return entry[1], entry[2]
+
+    def generation(self, tid):
+        with self.lock:
+            return self.generations.get(tid, 0)
+
+    def put(self, tid, view, etag, body, generation):
+        with self.lock:
+            if self.generations.get(tid, 0) != generation:
+                return
+            self.entries[(tid, view)] = (time.monotonic() + self.ttl, etag, body)
+            self.entries.move_to_end((tid, view))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, tids):
+        with self.lock:
+            for tid in tids:
+                self.generations[tid] = self.generations.get(tid, 0) + 1
+                for view in USER_CACHE_VIEWS:
+                    self.entries.pop((tid, view), None)
+
+class SQLiteUserCache(UserCache):
+    """Host-wide backend in a WAL-mode SQLite file, shared by every worker.
+
+    LRU is approximate: last use is written back at most every few seconds per
+    entry, and eviction runs on a sample of puts.
+    """
+    TOUCH_SECONDS = 5
+
+    def __init__(self, path, max_entries=USER_CACHE_MAX_ENTRIES, ttl=USER_CACHE_TTL):
+        self.path, self.max_entries, self.ttl = path, max_entries, ttl
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS user_cache (user_id INTEGER NOT NULL, view TEXT NOT NULL, "
+                     "etag TEXT NOT NULL, body TEXT NOT NULL, expires_at REAL NOT NULL, used_at REAL NOT NULL, "
+                     "PRIMARY KEY (user_id, view))")
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_user_cache_used ON user_cache (used_at)")
+        conn.execute("CREATE TABLE IF NOT EXISTS user_cache_gen (user_id INTEGER PRIMARY KEY, gen INTEGER NOT NULL)")
+
+    def _conn(self):
+        return sqlite_wal_connection(self.path)
+
+    def get(self, tid, view):
+        now = time.time()
+        row = self._conn().execute(
+            "SELECT etag, body, used_at FROM user_cache WHERE user_id = ? AND view = ? AND expires_at > ?",
+            (tid, view, now)).fetchone()
+        if row is None:
+            return None
+        if row[2] < now - self.TOUCH_SECONDS:
+            self._conn().execute("UPDATE user_cache SET used_at = ? WHERE user_id = ? AND view = ?", (now, tid, view))
+        return row[0], row[1]
+
+    def generation(self, tid):
+        row = self._conn().execute("SELECT gen FROM user_cache_gen WHERE user_id = ?", (tid,)).fetchone()
+        return row[0] if row else 0
+
+    def put(self, tid, view, etag, body, generation):
+        now = time.time()
+        conn = self._conn()
+        # The generation check and the write are one statement, so an invalidation can't slip in between
+        conn.execute(
+            "INSERT INTO user_cache SELECT ?, ?, ?, ?, ?, ? "
+            "WHERE COALESCE((SELECT gen FROM user_cache_gen WHERE user_id = ?), 0) = ? "
+            "ON CONFLICT (user_id, view) DO UPDATE SET etag = excluded.etag, body = excluded.body, "
+            "expires_at = excluded.expires_at, used_at = excluded.used_at",
+            (tid, view, etag, body, now + self.ttl, now, tid, generation))
+        if random.random() < 0.01:
+            conn.execute("DELETE FROM user_cache WHERE expires_at <= ?", (now,))
+            excess = conn.execute("SELECT COUNT(*) FROM user_cache").fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute("DELETE FROM user_cache WHERE (user_id, view) IN "
+                             "(SELECT user_id, view FROM user_cache ORDER BY used_at LIMIT ?)", (excess,))
+
+    def invalidate(self, tids):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT INTO user_cache_gen VALUES (?, 1) "
+                             "ON CONFLICT (user_id) DO UPDATE SET gen = gen + 1", [(t,) for t in tids])
+            conn.executemany("DELETE FROM user_cache WHERE user_id = ?", [(t,) for t in tids])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+user_cache = store_from_url(os.environ.get('USER_CACHE', 'sqlite'), MemoryUserCache, SQLiteUserCache, 'user_cache.db')
+
+def mark_user_changed(*tids, session=None):
+    """Drop these users' cached views once the current transaction commits"""
+    (session or db.session).info.setdefault('changed_users', set()).update(int(t) for t in tids if t is not None)
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_changed_users(session):
+    tids = session.info.pop('changed_users', None)
+    if tids:
+        user_cache.invalidate(tids)
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_changed_users(session):
+    session.info.pop('changed_users', None)
+
+def cached_view(tid, view, build):
+    """(body, etag) of a user's view, from the cache or build(); (None, None) if build() returns None"""
+    hit = user_cache.get(tid, view)
+    if hit is not None:
+        return hit[1], hit[0]
+    generation = user_cache.generation(tid)
+    data = build()
+    if data is None:
+        return None, None
+    body = json.dumps(data)
+    etag = hashlib.sha1(body.encode()).hexdigest()
+    user_cache.put(tid, view, etag, body, generation)
+    return body, etag
+
+def conditional_json(body, etag):
+    resp = Response(body, mimetype='application/json')
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp.make_conditional(request)
+
+# ─── AUTH ───────────────────────────────────────────────────────
+# /api/init checks Telegram's initData signature once and hands back a session
+# token "<telegram_id>.<expires>.<mac>" signed with SECRET_KEY. Routes that act
+# on the telegram_id in their body only check the token's MAC (skipped for
+# tokens this worker already verified) and that it names the same user.
+TELEGRAM_AUTH = os.environ.get('TELEGRAM_AUTH', '1') != '0'  # 0 trusts the body, for local demo only
+INIT_DATA_MAX_AGE = 24 * 3600
+SESSION_TTL = 24 * 3600
+SESSION_CACHE_SIZE = 10000
+SESSION_KEY = hmac.new(app.config['SECRET_KEY'].encode(), b'session', hashlib.sha256).digest()
+
+@lru_cache(maxsize=4)
+def webapp_secret(bot_token):
+    return hmac.new(b'WebAppData', bot_token.encode(), hashlib.sha256).digest()
+
+def init_data_hash(fields, bot_token=None):
+    """Telegram's WebApp signature over the sorted key=value lines of initData"""
+    check = '\n'.join(f'{k}={v}' for k, v in sorted(fields.items()) if k != 'hash')
+    return hmac.new(webapp_secret(bot_token or BOT_TOKEN), check.encode(), hashlib.sha256).hexdigest()
+
+def verify_init_data(init_data):
+    """initData query string -> Telegram user dict; raises ValueError unless our bot signed it recently"""
+    fields = dict(parse_qsl(init_data))
+    if not hmac.compare_digest(fields.get('hash', '').encode(), init_data_hash(fields).encode()):
+        raise ValueError('bad initData signature')
+    if time.time() - int(fields.get('auth_date', 0)) > INIT_DATA_MAX_AGE:
+        raise ValueError('initData expired')
+    user = json.loads(fields.get('user', '{}'))
+    if not isinstance(user.get('id'), int):
+        raise ValueError('initData has no user')
     return user
 
-def send_telegram_message(chat_id, text):
-    """Send message via Telegram Bot API"""
-    import requests
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-    payload = {"chat_id": chat_id, "text": text, "parse_mode": "HTML"}
-    try:
-        requests.post(url, json=payload, timeout=5)
-    except:
-        pass
-
-def notify_admin(text):
-    send_telegram_message(ADMIN_CHAT_ID, text)
+def sign_init_data(user, bot_token=None):
+    """initData as Telegram would send it for `user`; for the CLI checks"""
+    fields = {'auth_date': str(int(time.time())), 'user': json.dumps(user)}
+    fields['hash'] = init_data_hash(fields, bot_token)
+    return urlencode(fields)
+
+def session_mac(payload):
+    mac = hmac.new(SESSION_KEY, payload.encode(), hashlib.sha256).digest()[:18]
+    return base64.urlsafe_b64encode(mac).decode()
+
+def issue_session_token(tid):
+    payload = f'{tid}.{int(time.time()) + SESSION_TTL}'
+    return f'{payload}.{session_mac(payload)}'
+
+def check_session_signature(token):
+    """Token -> (telegram_id, expires_at), or None if we didn't sign it"""
+    payload, _, mac = token.rpartition('.')
+    tid, _, expires = payload.partition('.')
+    if not (tid.isdigit() and expires.isdigit()) or not hmac.compare_digest(mac.encode(), session_mac(payload).encode()):
+        return None
+    return int(tid), int(expires)
+
+class VerifiedSessions:
+    """Tokens this worker already checked: token -> (telegram_id, expires_at), LRU-bounded"""
+    def __init__(self, capacity=SESSION_CACHE_SIZE):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, token):
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is not None:
+                self.entries.move_to_end(token)
+            return entry
+
+    def put(self, token, entry):
+        with self.lock:
+            self.entries[token] = entry
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+verified_sessions = VerifiedSessions()
+
+def verify_session_token(token):
+    """Session token -> telegram_id, or None if forged or expired"""
+    entry = verified_sessions.get(token)
+    if entry is None:
+        entry = check_session_signature(token)
+        if entry is None:
+            return None
+        verified_sessions.put(token, entry)
+    return entry[0] if entry[1] > time.time() else None
+
+def require_session(view):
+    """Reject the call unless its Bearer token was issued to the body's telegram_id"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if TELEGRAM_AUTH:
+            scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+            tid = verify_session_token(token) if scheme == 'Bearer' else None
+            if tid is None:
+                return jsonify({'error': 'Unauthorized'}), 401
+            if str((request.get_json(silent=True) or {}).get('telegram_id')) != str(tid):
+                return jsonify({'error': 'Forbidden'}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+# ─── IDEMPOTENCY KEYS ───────────────────────────────────────────
+# Money-moving POSTs take an Idempotency-Key header, and a client retrying a
+# call sends the same key. The first call inserts the key's row in its own
+# transaction, so the claim commits or rolls back with the money change, and a
+# concurrent duplicate fails on the primary key. The response goes into this
+# worker's hot set and onto the row via a background thread; repeats are
+# answered from either without running the handler. A repeat that arrives
+# before the response is written gets 409 and retries; once the claim is older
+# than the lease, its worker died between the commit and the flush, and the
+# repeat gets 410: the call went through but its response is gone.
+IDEMPOTENCY_TTL = 24 * 3600
+IDEMPOTENCY_LEASE_SECONDS = 15
+IDEMPOTENCY_HOT_SIZE = 10000
+IDEMPOTENCY_FLUSH_SECONDS = 1
+IDEMPOTENCY_KEY_MAX_LENGTH = 64
+
+class IdempotencyStore:
+    """Responses by (telegram_id, key): LRU hot set, written behind to idempotency_key"""
+    def __init__(self, capacity=IDEMPOTENCY_HOT_SIZE):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # (telegram_id, key) -> (fingerprint, status, body)
+        self.pending = []  # responses not yet on their rows
+        self.cleaned_at = 0.0
+
+    def get(self, tid, key):
+        """(fingerprint, status, body), or (fingerprint, None, None, expires_at) while the response isn't
+        written; None if unknown"""
+        with self.lock:
+            entry = self.entries.get((tid, key))
+            if entry is not None:
+                self.entries.move_to_end((tid, key))
+                return entry
+        row = db.session.query(IdempotencyKey.fingerprint, IdempotencyKey.status, IdempotencyKey.body,
+                               IdempotencyKey.expires_at).filter_by(user_id=tid, key=key).first()
+        if row is None:
+            return None
+        if row.status is None:
+            return tuple(row)
+        self._remember(tid, key, tuple(row[:3]))
+        return tuple(row[:3])
+
+    def put(self, tid, key, fingerprint, response):
+        """Keep a committed call's response; the flusher writes it onto the claimed row"""
+        entry = (fingerprint, response.status_code, response.get_data(as_text=True))
+        with self.lock:
+            self._remember(tid, key, entry)
+            self.pending.append({'tid': tid, 'k': key, 'st': entry[1], 'b': entry[2]})
+
+    def _remember(self, tid, key, entry):
+        self.entries[(tid, key)] = entry
+        self.entries.move_to_end((tid, key))
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def flush(self):
+        """Write pending responses in one bulk UPDATE and hourly drop expired keys; needs an app context"""
+        with self.lock:
+            batch, self.pending = self.pending, []
+        evict = time.time() - self.cleaned_at > 3600
+        if not batch and not evict:
+            return 0
+        keys = IdempotencyKey.__table__
+        try:
+            if batch:
+                db.session.execute(keys.update().where(keys.c.user_id == db.bindparam('tid'),
+                                                       keys.c.key == db.bindparam('k'))
+                                   .values(status=db.bindparam('st'), body=db.bindparam('b')), batch)
+            if evict:
+                db.session.execute(keys.delete().where(keys.c.expires_at < datetime.utcnow()))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self.lock:  # keep them for the next flush
+                self.pending[:0] = batch
+            raise
+        if evict:
+            self.cleaned_at = time.time()
+        return len(batch)
+
+idempotency_store = IdempotencyStore()
+
+@event.listens_for(db.session, 'after_commit')
+def confirm_idempotency_claim(session):
+    claim = session.info.pop('idempotency_claim', None)
+    if claim is not None:
+        session.info['idempotency_committed'] = claim
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_idempotency_claim(session):
+    session.info.pop('idempotency_claim', None)
+
+def replay_response(stored):
+    resp = Response(stored[2], status=stored[1], mimetype='application/json')
+    resp.headers['Idempotent-Replayed'] = 'true'
+    return resp
+
+def idempotent(view):
+    """Run the call once per (telegram_id, Idempotency-Key); repeats get the first response back"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return view(*args, **kwargs)
+        if not 0 < len(key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+            return jsonify({'error': 'Invalid Idempotency-Key'}), 400
+        try:
+            tid = int((request.get_json(silent=True) or {}).get('telegram_id'))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid telegram_id'}), 400
+        fingerprint = hashlib.sha1(request.path.encode() + b'\n' + request.get_data()).hexdigest()
+        stored = idempotency_store.get(tid, key)
+        if stored is None:
+            db.session.add(IdempotencyKey(user_id=tid, key=key, fingerprint=fingerprint,
+                                          expires_at=datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_TTL)))
+            try:
+                db.session.flush()
+            except IntegrityError:  # claimed by a call on another worker, or one still running
+                db.session.rollback()
+                stored = idempotency_store.get(tid, key)
+            else:
+                db.session.info['idempotency_claim'] = (tid, key)
+                response = app.make_response(view(*args, **kwargs))
+                if db.session.info.pop('idempotency_committed', None) == (tid, key):
+                    idempotency_store.put(tid, key, fingerprint, response)
+                return response
+        if stored is not None and stored[0] != fingerprint:
+            return jsonify({'error': 'Idempotency-Key was used for a different request'}), 422
+        if stored is not None and stored[1] is None:
+            claimed_at = stored[3] - timedelta(seconds=IDEMPOTENCY_TTL)
+            if datetime.utcnow() - claimed_at > timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS):
+                return jsonify({'error': 'Request already completed; its response is no longer available'}), 410
+        if stored is None or stored[1] is None:
+            resp = jsonify({'error': 'Request is still being processed'})
+            resp.status_code, resp.headers['Retry-After'] = 409, str(IDEMPOTENCY_FLUSH_SECONDS)
+            return resp
+        return replay_response(stored)
+    return wrapper
+
+def start_idempotency_flusher():
+    return start_periodic('idempotency-flusher', idempotency_store.flush, IDEMPOTENCY_FLUSH_SECONDS, final_step=True)
 
 # ─── ROUTES ─────────────────────────────────────────────────────
 
@@ -174,8 +2099,15 @@ def admin_panel():
 @app.route('/api/init', methods=['POST'])
 def api_init():
     data = request.get_json()
+    if TELEGRAM_AUTH:
+        try:
+            tg_user = verify_init_data(data.get('init_data') or '')
+        except (ValueError, TypeError):
+            return jsonify({'error': 'Invalid initData'}), 401
+        data = dict(data, telegram_id=tg_user['id'], **{k: tg_user.get(k, '') for k in
+                                                         ('first_name', 'last_name', 'username', 'photo_url')})
     tid = data.get('telegram_id')
-    user = get_or_create_user(
+    user, changed = get_or_create_user(
         tid, data.get('first_name',''), data.get('last_name',''),
         data.get('username',''), data.get('photo_url','')
     )
@@ -183,246 +2115,273 @@ def api_init():
     ref_id = data.get('ref_id')
     if ref_id and user.ref_id is None and ref_id != tid:
         user.ref_id = ref_id
+        db.session.execute(
+            db.update(User).where(User.telegram_id == ref_id)
+              .values(ref_count=User.ref_count + 1, ref_deposited=User.ref_deposited + (user.total_deposited or 0)),
+            execution_options={'synchronize_session': False})
+        changed = True
+        mark_user_changed(ref_id)
+    if changed:  # a plain app open only touches the presence buffer
         db.session.commit()
+        leaderboard_cache.record(user)
 
     return jsonify({
         'telegram_id': user.telegram_id,
         'first_name': user.first_name,
         'username': user.username,
         'photo_url': user.photo_url,
-        'balance': user.balance,
-        'total_deposited': user.total_deposited,
+        'balance': from_nano(user.balance),
+        'total_deposited': from_nano(user.total_deposited),
         'games_played': user.games_played,
         'ref_id': user.ref_id,
         'ref_percent': user.ref_percent,
-        'ref_balance': user.ref_balance,
+        'ref_balance': from_nano(user.ref_balance),
+        'session_token': issue_session_token(user.telegram_id),
     })
 
 # ── BALANCE ──────────────────────────────────────────────────────
 @app.route('/api/balance/<int:telegram_id>', methods=['GET'])
 def get_balance(telegram_id):
-    user = User.query.filter_by(telegram_id=telegram_id).first()
-    if not user:
+    def build():
+        user = User.query.filter_by(telegram_id=telegram_id).first()
+        return user and {'balance': from_nano(user.balance), 'ref_balance': from_nano(user.ref_balance)}
+    body, etag = cached_view(telegram_id, 'balance', build)
+    if body is None:
         return jsonify({'error': 'not found'}), 404
-    return jsonify({'balance': user.balance, 'ref_balance': user.ref_balance})
+    return conditional_json(body, etag)
 
 # ── GIFT UPGRADE (ROULETTE) ─────────────────────────────────────
 @app.route('/api/gift_upgrade/spin', methods=['POST'])
+@require_session
+@idempotent
 def gift_upgrade_spin():
+    """Single spin, or `count` spins settled as one balance change (batch response)"""
     data = request.get_json()
     tid = data.get('telegram_id')
-    stake = float(data.get('stake', 0))
-    multiplier = float(data.get('multiplier', 1.3))
+    stake = to_nano(data.get('stake', 0))
+    multiplier = to_finite(data.get('multiplier', 1.3))
+    batch = 'count' in data
+    count = batch_count(data)
 
-    user = User.query.filter_by(telegram_id=tid).first()
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    if user.balance < stake:
-        return jsonify({'error': 'Insufficient balance'}), 400
     if stake <= 0:
         return jsonify({'error': 'Invalid stake'}), 400
     if multiplier < 1.3 or multiplier > 20:
         return jsonify({'error': 'Invalid multiplier'}), 400
+    if count is None:
+        return jsonify({'error': 'Invalid count'}), 400
 
     win_chance = calculate_win_chance(multiplier)
-    won = random.random() < win_chance
-
-    user.balance -= stake
-    user.games_played += 1
-
-    if won:
-        winnings = round(stake * multiplier, 4)
-        user.balance += winnings
-        result_amount = round(winnings - stake, 4)
-        result_text = 'win'
-    else:
-        winnings = 0
-        result_amount = -stake
-        result_text = 'lose'
+    outcomes = gift_upgrade_sampler(multiplier).draw_many(count)
+    win_result = round(stake * multiplier) - stake
+    results = [win_result if won else -stake for won in outcomes]
 
-    db.session.commit()
+    new_balance = apply_balance_delta(tid, sum(results), 'gift_upgrade', ref=f'x{count}' if batch else None,
+                                      require=stake * count, games_played=User.games_played + count)
+    if new_balance is None:
+        return balance_error(tid)
 
     # Save to history
+    details = {won: json.dumps({'won': won, 'win_chance': round(win_chance*100,1)}) for won in (True, False)}
+    if batch:
+        db.session.execute(db.insert(GameHistory), [
+            {'user_id': tid, 'game_type': 'gift_upgrade', 'stake': stake, 'result': result,
+             'multiplier': multiplier, 'details': details[won]} for won, result in zip(outcomes, results)])
+        db.session.commit()
+        return jsonify({
+            'count': count,
+            'stake': from_nano(stake),
+            'multiplier': multiplier,
+            'win_chance': round(win_chance * 100, 1),
+            'wins': outcomes.count(True),
+            'results': [{'won': won, 'result': from_nano(result)} for won, result in zip(outcomes, results)],
+            'net': from_nano(sum(results)),
+            'new_balance': from_nano(new_balance),
+        })
+
+    won, result_amount = outcomes[0], results[0]
     hist = GameHistory(user_id=tid, game_type='gift_upgrade', stake=stake,
-                       result=result_amount, multiplier=multiplier,
-                       details=json.dumps({'won': won, 'win_chance': round(win_chance*100,1)}))
+                       result=result_amount, multiplier=multiplier, details=details[won])
     db.session.add(hist)
+    db.session.flush()
+    history_id = hist.id
     db.session.commit()
 
     return jsonify({
         'won': won,
-        'stake': stake,
+        'stake': from_nano(stake),
         'multiplier': multiplier,
         'win_chance': round(win_chance * 100, 1),
-        'result': result_amount,
-        'new_balance': round(user.balance, 4),
-        'history_id': hist.id
+        'result': from_nano(result_amount),
+        'new_balance': from_nano(new_balance),
+        'history_id': history_id
     })
 
 # ── ROLLS GAME ───────────────────────────────────────────────────
 @app.route('/api/rolls/state', methods=['GET'])
 def rolls_state():
-    now = time.time()
-    elapsed = now - rolls_game_state['last_spin_time']
-    remaining = max(0, 10 - elapsed)
-
-    # If countdown expired, do the spin
-    if remaining <= 0 and rolls_game_state.get('needs_spin', True):
-        result = generate_rolls_result()
-        rolls_game_state['last_result'] = result
-        rolls_game_state['history'].insert(0, result)
-        if len(rolls_game_state['history']) > 100:
-            rolls_game_state['history'] = rolls_game_state['history'][:100]
-
-        # Resolve bets
-        payouts = {}
-        for uid_str, bet in rolls_game_state['bets'].items():
-            uid = int(uid_str)
-            user = User.query.filter_by(telegram_id=uid).first()
-            if not user:
+    """Read-only snapshot — rounds are resolved by the rolls scheduler"""
+    state = rolls_store.snapshot()
+    return jsonify(dict(rolls_public_state(state), last_payouts=state['last_payouts']))
+
+@app.route('/api/rolls/stream', methods=['GET'])
+def rolls_stream():
+    """Server-Sent Events: 'round' once per spin (with this user's payout), 'tick' every second"""
+    uid = str(request.args.get('telegram_id', type=int))
+    if not rolls_stream_slots.acquire(blocking=False):
+        resp = jsonify({'error': 'Too many open streams, poll /api/rolls/state'})
+        resp.status_code, resp.headers['Retry-After'] = 503, '30'
+        return resp
+
+    def generate():
+        version = None
+        deadline = time.time() + ROLLS_STREAM_MAX_SECONDS
+        yield 'retry: 2000\n\n'
+        while time.time() < deadline:
+            if 'rolls-scheduler' not in background_threads:
+                refresh_rolls_feed(rolls_store.snapshot())
+            with rolls_feed_cond:
+                rolls_feed_cond.wait_for(lambda: rolls_feed['version'] != version, timeout=1.0)
+                latest, state = rolls_feed['version'], rolls_feed['state']
+            if state is None:
                 continue
-            if bet['color'] == result:
-                mult = 10 if result == 'green' else 2
-                winnings = round(bet['amount'] * mult, 4)
-                user.balance += winnings
-                payouts[uid_str] = {'won': True, 'amount': winnings, 'mult': mult}
-                hist = GameHistory(user_id=uid, game_type='rolls', stake=bet['amount'],
-                                   result=round(winnings - bet['amount'], 4), multiplier=mult)
-                db.session.add(hist)
-            else:
-                payouts[uid_str] = {'won': False, 'amount': 0, 'mult': 0}
-                hist = GameHistory(user_id=uid, game_type='rolls', stake=bet['amount'],
-                                   result=-bet['amount'], multiplier=0)
-                db.session.add(hist)
-            user.games_played += 1
-        db.session.commit()
+            event, version = rolls_stream_event(uid, version, latest, state)
+            yield event
 
-        rolls_game_state['bets'] = {}
-        rolls_game_state['last_spin_time'] = now
-        rolls_game_state['needs_spin'] = True
-        rolls_game_state['last_payouts'] = payouts
-        remaining = 10
-
-    history = rolls_game_state['history'][:20]
-    red_count = history.count('red')
-    blue_count = history.count('blue')
-    green_count = history.count('green')
-
-    return jsonify({
-        'countdown': round(remaining, 2),
-        'last_result': rolls_game_state['last_result'],
-        'history': history,
-        'red_count': red_count,
-        'blue_count': blue_count,
-        'green_count': green_count,
-        'last_payouts': rolls_game_state.get('last_payouts', {})
-    })
+    resp = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    resp.call_on_close(rolls_stream_slots.release)
+    return resp
 
 @app.route('/api/rolls/bet', methods=['POST'])
+@require_session
 def rolls_bet():
     data = request.get_json()
     tid = data.get('telegram_id')
     color = data.get('color')
-    amount = float(data.get('amount', 0))
+    amount = to_nano(data.get('amount', 0))
 
     if color not in ('red', 'blue', 'green'):
         return jsonify({'error': 'Invalid color'}), 400
     if amount <= 0:
         return jsonify({'error': 'Invalid amount'}), 400
 
-    user = User.query.filter_by(telegram_id=tid).first()
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    if user.balance < amount:
-        return jsonify({'error': 'Insufficient balance'}), 400
-
     # Check countdown — can't bet if < 1 second left
-    elapsed = time.time() - rolls_game_state['last_spin_time']
-    if elapsed >= 9:
+    elapsed = time.time() - rolls_store.last_spin_time()
+    if elapsed >= ROLLS_BETTING_SECONDS:
         return jsonify({'error': 'Betting closed'}), 400
+    if rolls_store.has_bet(tid):
+        return jsonify({'error': 'Bet already placed'}), 400
 
-    user.balance -= amount
+    new_balance = apply_balance_delta(tid, -amount, 'rolls_bet')
+    if new_balance is None:
+        return balance_error(tid)
     db.session.commit()
 
-    rolls_game_state['bets'][str(tid)] = {'color': color, 'amount': amount}
-    rolls_game_state['needs_spin'] = True
+    try:
+        placed = rolls_store.place_bet(tid, color, amount)
+    except sqlite3.Error:
+        app.logger.exception('Rolls bet by %s not stored; refunding', tid)
+        placed = None
+    if not placed:  # a concurrent bet got in first, or the store failed
+        apply_balance_delta(tid, amount, 'rolls_refund')
+        db.session.commit()
+        if placed is None:
+            return jsonify({'error': 'Bet not placed, try again'}), 503
+        return jsonify({'error': 'Bet already placed'}), 400
 
-    return jsonify({'success': True, 'new_balance': round(user.balance, 4), 'bet': {'color': color, 'amount': amount}})
+    return jsonify({'success': True, 'new_balance': from_nano(new_balance), 'bet': {'color': color, 'amount': from_nano(amount)}})
 
 # ── MUTANTS (CASES) ─────────────────────────────────────────────
 @app.route('/api/mutants/check', methods=['POST'])
+@require_session
 def mutants_check():
     data = request.get_json()
     tid = data.get('telegram_id')
-    user = User.query.filter_by(telegram_id=tid).first()
-    if not user:
+    def build():
+        user = User.query.filter_by(telegram_id=tid).first()
+        if not user:
+            return None
+        if user.total_deposited < 5 * NANO:
+            return {'available': False, 'message': 'Игра доступна только при пополнении 5+ TON на баланс'}
+        return {'available': True}
+    body, _ = cached_view(int(tid), 'mutants_check', build) if str(tid).isdigit() else (None, None)
+    if body is None:
         return jsonify({'error': 'User not found'}), 404
-    if user.total_deposited < 5:
-        return jsonify({'available': False, 'message': 'Игра доступна только при пополнении 5+ TON на баланс'})
-    return jsonify({'available': True})
+    return Response(body, mimetype='application/json')
 
 @app.route('/api/mutants/open_case', methods=['POST'])
+@require_session
+@idempotent
 def mutants_open_case():
+    """Open one case, or `count` paid cases settled as one balance change (batch response)"""
     data = request.get_json()
     tid = data.get('telegram_id')
     case_type = data.get('case_type')  # 'free', 'regular', 'snoop'
+    batch = 'count' in data
+    count = batch_count(data)
 
-    user = User.query.filter_by(telegram_id=tid).first()
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
+    case_costs = {'free': 0, 'regular': 5 * NANO, 'snoop': 7 * NANO}
+    if case_type not in case_costs:
+        return jsonify({'error': 'Invalid case type'}), 400
+    if count is None or (case_type == 'free' and count != 1):
+        return jsonify({'error': 'Invalid count'}), 400
+    cost = case_costs[case_type]
 
-    case_costs = {'free': 0, 'regular': 5, 'snoop': 7}
-    cost = case_costs.get(case_type, 0)
-
-    # Free case cooldown check
-    if case_type == 'free':
-        if user.free_case_last:
-            cooldown_end = user.free_case_last + timedelta(hours=24)
-            if datetime.utcnow() < cooldown_end:
-                remaining = cooldown_end - datetime.utcnow()
-                hours = remaining.seconds // 3600
-                minutes = (remaining.seconds % 3600) // 60
-                return jsonify({'error': f'Кейс будет доступен через {hours}ч {minutes}м'})
-
-    if user.balance < cost:
-        return jsonify({'error': 'Insufficient balance'}), 400
-
-    user.balance -= cost
+    now = datetime.utcnow()
+    rewards = spin_cases(case_type, count)
+    credit = sum(r['value'] for r in rewards if r['type'] == 'ton')
+    values = {'games_played': User.games_played + count}
+    cooldown_ok = None
     if case_type == 'free':
-        user.free_case_last = datetime.utcnow()
-
-    reward = spin_case(case_type)
-    user.games_played += 1
-
-    # Credit TON rewards to balance
-    if reward['type'] == 'ton':
-        user.balance += reward['sell_price']
-    elif reward['type'] == 'nft':
-        inv = Inventory(user_id=tid, gift_name=reward['name'],
-                        gift_image=reward.get('image', '🎁'), sell_price=reward['sell_price'])
-        db.session.add(inv)
-
-    db.session.commit()
-
-    hist = GameHistory(user_id=tid, game_type='mutants', stake=cost,
-                       result=reward['sell_price'] - cost,
-                       details=json.dumps({'case_type': case_type, 'reward': reward['name']}))
-    db.session.add(hist)
+        # Claiming the free case and checking its cooldown happen in the same UPDATE
+        cooldown_ok = db.or_(User.free_case_last.is_(None), User.free_case_last <= now - timedelta(hours=24))
+        values['free_case_last'] = now
+
+    new_balance = apply_balance_delta(tid, credit - cost * count, 'mutants',
+                                      ref=f'{case_type} x{count}' if batch else case_type,
+                                      require=cost * count, where=cooldown_ok, **values)
+    if new_balance is None:
+        user = User.query.filter_by(telegram_id=tid).first()
+        if user and case_type == 'free' and user.free_case_last:
+            remaining = user.free_case_last + timedelta(hours=24) - datetime.utcnow()
+            hours = remaining.seconds // 3600
+            minutes = (remaining.seconds % 3600) // 60
+            return jsonify({'error': f'Кейс будет доступен через {hours}ч {minutes}м'})
+        return balance_error(tid)
+
+    nfts = [r for r in rewards if r['type'] == 'nft']
+    if nfts:
+        add_to_inventory(tid, nfts, now)
+    db.session.execute(db.insert(GameHistory), [
+        {'user_id': tid, 'game_type': 'mutants', 'stake': cost, 'result': r['value'] - cost,
+         'details': json.dumps({'case_type': case_type, 'reward': r['name']})} for r in rewards])
     db.session.commit()
 
+    if batch:
+        return jsonify({
+            'count': count,
+            'rewards': [reward_json(r) for r in rewards],
+            'net': from_nano(credit - cost * count),
+            'new_balance': from_nano(new_balance),
+        })
     return jsonify({
-        'reward': reward,
-        'new_balance': round(user.balance, 4)
+        'reward': reward_json(rewards[0]),
+        'new_balance': from_nano(new_balance)
     })
 
 @app.route('/api/mutants/free_case_status', methods=['GET'])
 def free_case_status():
+    # Only the claim time is cached: remaining_seconds changes every second, so no ETag here
     tid = request.args.get('telegram_id', type=int)
-    user = User.query.filter_by(telegram_id=tid).first()
-    if not user:
+    def build():
+        user = User.query.filter_by(telegram_id=tid).first()
+        return user and {'free_case_last': user.free_case_last and user.free_case_last.isoformat()}
+    body, _ = cached_view(tid, 'free_case', build) if tid is not None else (None, None)
+    if body is None:
         return jsonify({'available': True})
-    if user.free_case_last:
-        cooldown_end = user.free_case_last + timedelta(hours=24)
+    free_case_last = json.loads(body)['free_case_last']
+    if free_case_last:
+        cooldown_end = datetime.fromisoformat(free_case_last) + timedelta(hours=24)
         if datetime.utcnow() < cooldown_end:
             remaining = cooldown_end - datetime.utcnow()
             total_seconds = int(remaining.total_seconds())
@@ -432,119 +2391,178 @@ def free_case_status():
 # ── INVENTORY ────────────────────────────────────────────────────
 @app.route('/api/inventory/<int:telegram_id>', methods=['GET'])
 def get_inventory(telegram_id):
-    items = Inventory.query.filter_by(user_id=telegram_id).order_by(Inventory.obtained_at.desc()).all()
-    return jsonify([{'id': i.id, 'name': i.gift_name, 'image': i.gift_image, 'sell_price': i.sell_price} for i in items])
+    try:
+        items, next_cursor = keyset_page(
+            db.select(Inventory.id, Inventory.quantity, Gift.name, Gift.image, Gift.sell_price)
+              .join(Gift, Gift.id == Inventory.gift_id)
+              .where(Inventory.user_id == telegram_id, Inventory.quantity > 0), Inventory.id)
+    except ValueError:
+        return jsonify({'error': 'Invalid page'}), 400
+    return paged_response([{'id': i.id, 'name': i.name, 'image': i.image, 'sell_price': from_nano(i.sell_price),
+                            'quantity': i.quantity} for i in items], next_cursor)
 
 @app.route('/api/inventory/sell', methods=['POST'])
+@require_session
 def sell_inventory():
     data = request.get_json()
     tid = data.get('telegram_id')
     item_id = data.get('item_id')
 
-    item = Inventory.query.get(item_id)
-    if not item or item.user_id != tid:
+    # The guarded decrement is the claim on the unit: a concurrent sell of the last one finds nothing
+    unit_price = db.select(Gift.sell_price).where(Gift.id == Inventory.gift_id).scalar_subquery()
+    row = db.session.execute(
+        db.update(Inventory).where(Inventory.id == item_id, Inventory.user_id == tid, Inventory.quantity > 0)
+          .values(quantity=Inventory.quantity - 1).returning(unit_price),
+        execution_options={'synchronize_session': False}).first()
+    if row is None:
         return jsonify({'error': 'Item not found'}), 404
 
-    user = User.query.filter_by(telegram_id=tid).first()
-    user.balance += item.sell_price
-    db.session.delete(item)
+    sold_price = row[0]
+    new_balance = apply_balance_delta(tid, sold_price, 'inventory_sell', ref=f'inventory:{item_id}')
+    if new_balance is None:
+        db.session.rollback()
+        return jsonify({'error': 'User not found'}), 404
+    db.session.commit()
+    return jsonify({'success': True, 'sold_price': from_nano(sold_price), 'new_balance': from_nano(new_balance)})
+
+@app.route('/api/inventory/sell_all', methods=['POST'])
+@require_session
+def sell_inventory_bulk():
+    """Sell the whole inventory, or every unit of the stacks in `item_ids`, in one update and one credit"""
+    data = request.get_json()
+    tid = data.get('telegram_id')
+    item_ids = data.get('item_ids')
+    if item_ids is not None and (not isinstance(item_ids, list) or not all(isinstance(i, int) for i in item_ids)):
+        return jsonify({'error': 'Invalid item_ids'}), 400
+
+    query = db.select(Inventory.id, Inventory.quantity, Gift.sell_price).join(Gift, Gift.id == Inventory.gift_id) \
+              .where(Inventory.user_id == tid, Inventory.quantity > 0)
+    if item_ids is not None:
+        query = query.where(Inventory.id.in_(item_ids))
+    stacks = {row.id: row for row in db.session.execute(query)}
+    if not stacks:
+        return jsonify({'error': 'Item not found'}), 404
+    # Only stacks still holding what we read are emptied, so a concurrent sell can't be paid twice
+    emptied = db.session.execute(
+        db.update(Inventory).where(db.tuple_(Inventory.id, Inventory.quantity).in_(
+            [(row.id, row.quantity) for row in stacks.values()]))
+          .values(quantity=0).returning(Inventory.id),
+        execution_options={'synchronize_session': False}).scalars().all()
+    if not emptied:
+        return jsonify({'error': 'Item not found'}), 404
+
+    sold_count = sum(stacks[i].quantity for i in emptied)
+    total = sum(stacks[i].quantity * stacks[i].sell_price for i in emptied)
+    new_balance = apply_balance_delta(tid, total, 'inventory_sell', ref=f'inventory:x{sold_count}')
+    if new_balance is None:
+        db.session.rollback()
+        return jsonify({'error': 'User not found'}), 404
     db.session.commit()
-    return jsonify({'success': True, 'sold_price': item.sell_price, 'new_balance': round(user.balance, 4)})
+    return jsonify({'success': True, 'sold_count': sold_count, 'sold_price': from_nano(total),
+                    'new_balance': from_nano(new_balance)})
 
 @app.route('/api/inventory/withdraw_gift', methods=['POST'])
+@require_session
 def withdraw_gift():
     """User wants to withdraw a gift - returns instructions"""
     data = request.get_json()
+    tid = data.get('telegram_id')
     item_id = data.get('item_id')
-    item = Inventory.query.get(item_id)
-    if not item:
+    gift_name = db.session.query(Gift.name).join(Inventory, Inventory.gift_id == Gift.id) \
+                  .filter(Inventory.id == item_id, Inventory.user_id == tid, Inventory.quantity > 0).scalar()
+    if not gift_name:
         return jsonify({'error': 'Item not found'}), 404
-    return jsonify({'message': f'Напишите Админу слово "Hi" и название подарка: {item.gift_name}'})
+    return jsonify({'message': f'Напишите Админу слово "Hi" и название подарка: {gift_name}'})
 
 # ── LEADERBOARD ──────────────────────────────────────────────────
 @app.route('/api/leaderboard', methods=['GET'])
 def leaderboard():
-    users = User.query.order_by(User.total_deposited.desc()).limit(35).all()
-    board = []
-    for i, u in enumerate(users):
-        board.append({
-            'rank': i + 1,
-            'telegram_id': u.telegram_id,
-            'name': u.first_name or 'User',
-            'username': u.username,
-            'photo_url': u.photo_url,
-            'total_deposited': u.total_deposited,
-        })
-    return jsonify(board)
+    body, etag = leaderboard_cache.snapshot()
+    resp = Response(body, mimetype='application/json')
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp.make_conditional(request)
 
 # ── REFERRALS ────────────────────────────────────────────────────
 @app.route('/api/referrals/<int:telegram_id>', methods=['GET'])
 def get_referrals(telegram_id):
-    refs = User.query.filter_by(ref_id=telegram_id).all()
-    user = User.query.filter_by(telegram_id=telegram_id).first()
-    return jsonify({
-        'referrals': [{'name': r.first_name, 'username': r.username, 'total_deposited': r.total_deposited} for r in refs],
-        'total_referred': len(refs),
-        'ref_balance': user.ref_balance if user else 0,
-        'ref_percent': user.ref_percent if user else 10
-    })
+    def build():
+        user = User.query.filter_by(telegram_id=telegram_id).first()
+        refs, next_cursor = referee_page(telegram_id)
+        return {
+            'referrals': [{'name': r.first_name, 'username': r.username, 'total_deposited': from_nano(r.total_deposited)} for r in refs],
+            'next_cursor': next_cursor,
+            'total_referred': user.ref_count if user else 0,
+            'ref_deposited': from_nano(user.ref_deposited) if user else 0,
+            'ref_earned': from_nano(user.ref_earned) if user else 0,
+            'ref_balance': from_nano(user.ref_balance) if user else 0,
+            'ref_percent': user.ref_percent if user else 10
+        }
+    try:
+        if 'cursor' in request.args or 'limit' in request.args:  # only the first page is cached
+            return jsonify(build())
+        return conditional_json(*cached_view(telegram_id, 'referrals', build))
+    except ValueError:
+        return jsonify({'error': 'Invalid page'}), 400
 
 @app.route('/api/referrals/withdraw', methods=['POST'])
+@require_session
 def withdraw_ref_balance():
     data = request.get_json()
     tid = data.get('telegram_id')
     user = User.query.filter_by(telegram_id=tid).first()
     if not user:
         return jsonify({'error': 'User not found'}), 404
-    if user.ref_balance < 3:
+    amount = user.ref_balance
+    if amount < 3 * NANO:
+        return jsonify({'error': 'Минимум 3 TON для вывода реферального баланса'})
+    # Move exactly what we read; a commission credited meanwhile stays on ref_balance
+    new_balance = apply_balance_delta(tid, amount, 'ref_withdraw', where=User.ref_balance >= amount,
+                                      ref_balance=User.ref_balance - amount)
+    if new_balance is None:
         return jsonify({'error': 'Минимум 3 TON для вывода реферального баланса'})
-    user.balance += user.ref_balance
-    user.ref_balance = 0
+    db.session.add(LedgerEntry(user_id=tid, account='ref', delta=-amount, reason='ref_withdraw'))
     db.session.commit()
-    return jsonify({'success': True, 'transferred': True, 'new_balance': round(user.balance, 4)})
+    return jsonify({'success': True, 'transferred': True, 'new_balance': from_nano(new_balance)})
 
 # ── DEPOSITS ─────────────────────────────────────────────────────
 @app.route('/api/deposit/stars', methods=['POST'])
+@require_session
+@idempotent
 def deposit_stars():
     """Handle Telegram Stars deposit (simulated — real impl needs Telegram payment webhook)"""
     data = request.get_json()
     tid = data.get('telegram_id')
-    stars = int(data.get('stars', 0))
-    if stars <= 0:
+    ton_amount = stars_to_nano(data.get('stars', 0))
+    if ton_amount <= 0:
         return jsonify({'error': 'Invalid stars amount'}), 400
 
-    ton_amount = round(stars * 1.099 / 100, 4)  # 100 stars = 1.099 TON
-
-    user = User.query.filter_by(telegram_id=tid).first()
-    if not user:
+    new_balance = apply_balance_delta(tid, ton_amount, 'deposit_stars',
+                                      total_deposited=User.total_deposited + ton_amount)
+    if new_balance is None:
         return jsonify({'error': 'User not found'}), 404
 
-    user.balance += ton_amount
-    user.total_deposited += ton_amount
-
     # Credit referrer
-    if user.ref_id:
-        referrer = User.query.filter_by(telegram_id=user.ref_id).first()
-        if referrer:
-            ref_bonus = round(ton_amount * referrer.ref_percent / 100, 4)
-            referrer.ref_balance += ref_bonus
-            db.session.commit()
-
-    db.session.commit()
+    credit_referrer(tid, ton_amount, 'ref_bonus')
+    record_deposit(ton_amount)
 
     rec = DepositRecord(user_id=tid, amount=ton_amount, method='stars', status='completed')
     db.session.add(rec)
+    depositor = db.session.query(User.telegram_id, User.first_name, User.username,
+                                 User.photo_url, User.total_deposited).filter_by(telegram_id=tid).one()
+    notify_admin(f"💰 Новое пополнение через Stars!\nПользователь ID: {tid} ({depositor.first_name})\nСумма: {ton_amount // STARS_NANO} Stars = {from_nano(ton_amount)} TON")
     db.session.commit()
+    leaderboard_cache.record(depositor)
 
-    notify_admin(f"💰 Новое пополнение через Stars!\nПользователь ID: {tid} ({user.first_name})\nСумма: {stars} Stars = {ton_amount} TON")
-    return jsonify({'success': True, 'ton_amount': ton_amount, 'new_balance': round(user.balance, 4)})
+    return jsonify({'success': True, 'ton_amount': from_nano(ton_amount), 'new_balance': from_nano(new_balance)})
 
 @app.route('/api/deposit/ton', methods=['POST'])
+@require_session
 def deposit_ton():
     """Initiate TON deposit — user connects wallet, we give them a unique memo"""
     data = request.get_json()
     tid = data.get('telegram_id')
-    amount = float(data.get('amount', 0))
+    amount = to_nano(data.get('amount', 0))
     if amount <= 0:
         return jsonify({'error': 'Invalid amount'}), 400
 
@@ -555,84 +2573,102 @@ def deposit_ton():
 
     # Bot address where user should send TON
     bot_wallet = os.environ.get('BOT_WALLET_ADDRESS', 'UQD...')
-    return jsonify({'wallet_address': bot_wallet, 'memo': memo, 'amount': amount, 'deposit_id': rec.id})
+    return jsonify({'wallet_address': bot_wallet, 'memo': memo, 'amount': from_nano(amount), 'deposit_id': rec.id})
 
 @app.route('/api/deposit/confirm', methods=['POST'])
 def confirm_deposit():
     """Admin or webhook confirms a TON deposit"""
     data = request.get_json()
-    deposit_id = data.get('deposit_id')
-    rec = DepositRecord.query.get(deposit_id)
+    body, status, depositor = settle_deposit(db.session, data.get('deposit_id'))
+    if depositor is None:
+        db.session.rollback()
+        return jsonify(body), status
+    db.session.commit()
+    leaderboard_cache.record(depositor)
+    return jsonify(body), status
+
+def settle_deposit(session, deposit_id):
+    """Credit a pending TON deposit in `session`; returns (body, status, depositor or None).
+
+    The caller commits when a depositor comes back and rolls back otherwise.
+    """
+    rec = session.get(DepositRecord, deposit_id) if deposit_id is not None else None
     if not rec:
-        return jsonify({'error': 'Deposit not found'}), 404
+        return {'error': 'Deposit not found'}, 404, None
+
+    # Flip pending -> completed atomically so a repeated confirm can't credit twice
+    claimed = session.execute(
+        db.update(DepositRecord).where(DepositRecord.id == rec.id, DepositRecord.status == 'pending')
+          .values(status='completed'),
+        execution_options={'synchronize_session': False}).rowcount
+    if not claimed:
+        return {'error': 'Deposit already confirmed'}, 400, None
 
-    rec.status = 'completed'
-    user = User.query.filter_by(telegram_id=rec.user_id).first()
-    user.balance += rec.amount
-    user.total_deposited += rec.amount
+    new_balance = apply_balance_delta(rec.user_id, rec.amount, 'deposit_ton', ref=f'deposit:{rec.id}',
+                                      session=session, total_deposited=User.total_deposited + rec.amount)
+    if new_balance is None:
+        return {'error': 'User not found'}, 404, None
 
     # Credit referrer
-    if user.ref_id:
-        referrer = User.query.filter_by(telegram_id=user.ref_id).first()
-        if referrer:
-            ref_bonus = round(rec.amount * referrer.ref_percent / 100, 4)
-            referrer.ref_balance += ref_bonus
+    credit_referrer(rec.user_id, rec.amount, 'ref_bonus', session)
+    record_deposit(rec.amount, session)
 
-    db.session.commit()
-    notify_admin(f"💰 Подтверждено пополнение TON!\nПользователь: {user.first_name} (ID: {rec.user_id})\nСумма: {rec.amount} TON")
-    return jsonify({'success': True, 'new_balance': round(user.balance, 4)})
+    depositor = session.query(User.telegram_id, User.first_name, User.username,
+                              User.photo_url, User.total_deposited).filter_by(telegram_id=rec.user_id).one()
+    notify_admin(f"💰 Подтверждено пополнение TON!\nПользователь: {depositor.first_name} (ID: {rec.user_id})\nСумма: {from_nano(rec.amount)} TON", session)
+    return {'success': True, 'new_balance': from_nano(new_balance)}, 200, depositor
 
 # ── WITHDRAWALS ──────────────────────────────────────────────────
 @app.route('/api/withdraw/create', methods=['POST'])
+@require_session
+@idempotent
 def create_withdrawal():
     data = request.get_json()
     tid = data.get('telegram_id')
-    amount = float(data.get('amount', 0))
+    amount = to_nano(data.get('amount', 0))
     wallet = data.get('wallet_address', '')
 
     user = User.query.filter_by(telegram_id=tid).first()
     if not user:
         return jsonify({'error': 'User not found'}), 404
-    if amount < 10:
+    if amount < 10 * NANO:
         return jsonify({'error': 'Минимум вывода 10 TON'})
-    if user.balance < amount:
-        return jsonify({'error': 'Недостаточный баланс'})
     if not wallet:
         return jsonify({'error': 'Укажите адрес кошелёка'})
 
-    user.balance -= amount
-    db.session.commit()
-
     wr = WithdrawalRequest(user_id=tid, amount=amount, wallet_address=wallet)
     db.session.add(wr)
+    db.session.flush()
+    new_balance = apply_balance_delta(tid, -amount, 'withdrawal', ref=f'withdrawal:{wr.id}')
+    if new_balance is None:
+        db.session.rollback()
+        return jsonify({'error': 'Недостаточный баланс'})
+    notify_admin(f"📤 Запрос на вывод!\nПользователь: {user.first_name} (ID: {tid})\nСумма: {from_nano(amount)} TON\nКошелёк: {wallet}\nID заявки: {wr.id}")
     db.session.commit()
 
-    notify_admin(f"📤 Запрос на вывод!\nПользователь: {user.first_name} (ID: {tid})\nСумма: {amount} TON\nКошелёк: {wallet}\nID заявки: {wr.id}")
-    return jsonify({'success': True, 'request_id': wr.id, 'new_balance': round(user.balance, 4)})
+    return jsonify({'success': True, 'request_id': wr.id, 'new_balance': from_nano(new_balance)})
 
 @app.route('/api/withdraw/status/<int:telegram_id>', methods=['GET'])
 def get_withdrawal_status(telegram_id):
-    reqs = WithdrawalRequest.query.filter_by(user_id=telegram_id).order_by(WithdrawalRequest.created_at.desc()).all()
-    return jsonify([{
-        'id': r.id, 'amount': r.amount, 'status': r.status,
+    try:
+        reqs, next_cursor = keyset_page(
+            db.select(WithdrawalRequest.id, WithdrawalRequest.amount, WithdrawalRequest.status,
+                      WithdrawalRequest.admin_note, WithdrawalRequest.created_at)
+              .where(WithdrawalRequest.user_id == telegram_id), WithdrawalRequest.created_at, WithdrawalRequest.id)
+    except ValueError:
+        return jsonify({'error': 'Invalid page'}), 400
+    return paged_response([{
+        'id': r.id, 'amount': from_nano(r.amount), 'status': r.status,
         'admin_note': r.admin_note,
         'created_at': r.created_at.strftime('%d.%m %H:%M')
-    } for r in reqs])
+    } for r in reqs], next_cursor)
 
 # ── ADMIN ENDPOINTS ─────────────────────────────────────────────
 @app.route('/api/admin/stats', methods=['GET'])
 def admin_stats():
-    total_users = User.query.count()
-    now = datetime.utcnow()
-    online_24h = User.query.filter(User.last_online >= now - timedelta(hours=24)).count()
-    online_now = User.query.filter(User.last_online >= now - timedelta(minutes=5)).count()
-    total_deposited = db.session.query(db.func.sum(User.total_deposited)).scalar() or 0
-    return jsonify({
-        'total_users': total_users,
-        'online_24h': online_24h,
-        'online_now': online_now,
-        'total_deposited': round(total_deposited, 4)
-    })
+    stats = read_stats()
+    stats['total_deposited'] = from_nano(stats['total_deposited'])
+    return jsonify(stats)
 
 @app.route('/api/admin/user/<int:telegram_id>', methods=['GET'])
 def admin_get_user(telegram_id):
@@ -640,7 +2676,10 @@ def admin_get_user(telegram_id):
     if not user:
         return jsonify({'error': 'Not found'}), 404
 
-    refs = User.query.filter_by(ref_id=telegram_id).all()
+    try:
+        refs, next_cursor = referee_page(telegram_id)
+    except ValueError:
+        return jsonify({'error': 'Invalid page'}), 400
     history = GameHistory.query.filter_by(user_id=telegram_id).order_by(GameHistory.played_at.desc()).limit(20).all()
 
     return jsonify({
@@ -648,16 +2687,20 @@ def admin_get_user(telegram_id):
             'telegram_id': user.telegram_id,
             'first_name': user.first_name,
             'username': user.username,
-            'balance': user.balance,
-            'total_deposited': user.total_deposited,
+            'balance': from_nano(user.balance),
+            'total_deposited': from_nano(user.total_deposited),
             'games_played': user.games_played,
             'ref_percent': user.ref_percent,
-            'ref_balance': user.ref_balance,
+            'ref_balance': from_nano(user.ref_balance),
+            'ref_count': user.ref_count,
+            'ref_deposited': from_nano(user.ref_deposited),
+            'ref_earned': from_nano(user.ref_earned),
             'created_at': user.created_at.strftime('%d.%m.%Y %H:%M'),
             'last_online': user.last_online.strftime('%d.%m.%Y %H:%M'),
         },
-        'referrals': [{'name': r.first_name, 'deposited': r.total_deposited} for r in refs],
-        'game_history': [{'type': h.game_type, 'stake': h.stake, 'result': h.result, 'played_at': h.played_at.strftime('%d.%m %H:%M')} for h in history]
+        'referrals': [{'name': r.first_name, 'deposited': from_nano(r.total_deposited)} for r in refs],
+        'referrals_next_cursor': next_cursor,
+        'game_history': [{'type': h.game_type, 'stake': from_nano(h.stake), 'result': from_nano(h.result), 'played_at': h.played_at.strftime('%d.%m %H:%M')} for h in history]
     })
 
 @app.route('/api/admin/user/update', methods=['POST'])
@@ -668,14 +2711,21 @@ def admin_update_user():
     if not user:
         return jsonify({'error': 'Not found'}), 404
 
+    new_balance = user.balance
     if 'balance_add' in data:
-        user.balance += float(data['balance_add'])
+        new_balance = apply_balance_delta(tid, to_nano(data['balance_add']), 'admin_adjust', require=0)
     if 'balance_set' in data:
-        user.balance = float(data['balance_set'])
+        current = db.session.query(User.balance).filter_by(telegram_id=tid).scalar()
+        new_balance = apply_balance_delta(tid, to_nano(data['balance_set']) - current, 'admin_set', require=0,
+                                          where=User.balance == current)
+        if new_balance is None:
+            db.session.rollback()
+            return jsonify({'error': 'Balance changed meanwhile, try again'}), 409
     if 'ref_percent' in data:
         user.ref_percent = float(data['ref_percent'])
+        mark_user_changed(tid)
     db.session.commit()
-    return jsonify({'success': True, 'new_balance': round(user.balance, 4)})
+    return jsonify({'success': True, 'new_balance': from_nano(new_balance)})
 
 @app.route('/api/admin/withdrawal/<int:wr_id>/action', methods=['POST'])
 def admin_withdrawal_action(wr_id):
@@ -687,25 +2737,68 @@ def admin_withdrawal_action(wr_id):
     if not wr:
         return jsonify({'error': 'Not found'}), 404
 
-    wr.status = 'approved' if action == 'approve' else 'rejected'
-    wr.admin_note = note
-    wr.updated_at = datetime.utcnow()
-    db.session.commit()
+    # Only a pending request can be decided, and only once — otherwise a double click refunds twice
+    status = 'approved' if action == 'approve' else 'rejected'
+    decided = db.session.execute(
+        db.update(WithdrawalRequest).where(WithdrawalRequest.id == wr_id, WithdrawalRequest.status == 'pending')
+          .values(status=status, admin_note=note, updated_at=datetime.utcnow()),
+        execution_options={'synchronize_session': False}).rowcount
+    if not decided:
+        return jsonify({'error': f'Already {wr.status}'}), 400
 
     # If rejected, refund
     if action == 'reject':
-        user = User.query.filter_by(telegram_id=wr.user_id).first()
-        if user:
-            user.balance += wr.amount
-            db.session.commit()
+        apply_balance_delta(wr.user_id, wr.amount, 'withdrawal_refund', ref=f'withdrawal:{wr.id}')
 
     # Notify user
-    msg = f"{'✅ Вывод одобрен' if action == 'approve' else '❌ Вывод отклонён'}: {wr.amount} TON"
+    msg = f"{'✅ Вывод одобрен' if action == 'approve' else '❌ Вывод отклонён'}: {from_nano(wr.amount)} TON"
     if note:
         msg += f"\nПримечание: {note}"
     send_telegram_message(wr.user_id, msg)
+    db.session.commit()
 
-    return jsonify({'success': True, 'status': wr.status})
+    return jsonify({'success': True, 'status': status})
+
+EXPORTS = {
+    'history': GameHistory,
+    'inventory': Inventory,
+    'withdrawals': WithdrawalRequest,
+    'deposits': DepositRecord,
+    'ledger': LedgerEntry,
+}
+EXPORT_BATCH_SIZE = 1000
+
+@app.route('/api/admin/export/<kind>', methods=['GET'])
+def admin_export(kind):
+    """Stream a table as NDJSON (optionally one user's rows) without building the list in memory"""
+    model = EXPORTS.get(kind)
+    if model is None:
+        return jsonify({'error': 'Unknown export'}), 404
+    table = model.__table__
+    money = set(MONEY_COLUMNS.get(table.name, ()))
+    stmt = db.select(table).order_by(table.c.id)
+    if request.args.get('telegram_id', '').isdigit():
+        stmt = stmt.where(table.c.user_id == int(request.args['telegram_id']))
+
+    def row_json(row):
+        out = {}
+        for key, value in row.items():
+            if key in money:
+                value = from_nano(value)
+            elif isinstance(value, datetime):
+                value = value.isoformat()
+            out[key] = value
+        return json.dumps(out, ensure_ascii=False) + '\n'
+
+    def generate():
+        # yield_per streams from a server-side cursor where the driver has one (PostgreSQL)
+        without_statement_timeout(db.session.connection())
+        result = db.session.execute(stmt, execution_options={'yield_per': EXPORT_BATCH_SIZE})
+        for row in result.mappings():
+            yield row_json(row)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': f'attachment; filename={kind}.ndjson'})
 
 @app.route('/api/admin/withdrawals/pending', methods=['GET'])
 def admin_pending_withdrawals():
@@ -717,12 +2810,29 @@ def admin_pending_withdrawals():
             'id': r.id,
             'user_name': user.first_name if user else 'Unknown',
             'user_id': r.user_id,
-            'amount': r.amount,
+            'amount': from_nano(r.amount),
             'wallet': r.wallet_address,
             'created_at': r.created_at.strftime('%d.%m %H:%M')
         })
     return jsonify(result)
 
+@app.route('/api/admin/profiling', methods=['GET', 'POST'])
+def admin_profiling():
+    """GET: profiler settings and the recent profiles of every worker. POST: change the settings"""
+    settings = metrics_store.profiling()
+    if request.method == 'POST':
+        data = request.get_json()
+        try:
+            rate = float(data.get('sample_rate', settings['sample_rate']))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid sample_rate'}), 400
+        if not 0 <= rate <= 1:
+            return jsonify({'error': 'Invalid sample_rate'}), 400
+        settings = {'enabled': bool(data.get('enabled', settings['enabled'])), 'sample_rate': rate}
+        metrics_store.set_profiling(**settings)
+        profiling['read_at'] = 0.0  # this worker picks it up on the next request, the others within a second
+    return jsonify(dict(settings, profiles=metrics_store.profiles()))
+
 @app.route('/api/admin/users/search', methods=['GET'])
 def admin_search_users():
     q = request.args.get('q', '')
@@ -731,7 +2841,7 @@ def admin_search_users():
         User.first_name.ilike(f'%{q}%') |
         User.username.ilike(f'%{q}%')
     ).limit(20).all()
-    return jsonify([{'telegram_id': u.telegram_id, 'name': u.first_name, 'username': u.username, 'balance': u.balance} for u in users])
+    return jsonify([{'telegram_id': u.telegram_id, 'name': u.first_name, 'username': u.username, 'balance': from_nano(u.balance)} for u in users])
 
 # ── GAME HISTORY (last played) ──────────────────────────────────
 @app.route('/api/history/last/<int:telegram_id>', methods=['GET'])
@@ -741,21 +2851,740 @@ def last_game(telegram_id):
         return jsonify(None)
     return jsonify({
         'game_type': h.game_type,
-        'stake': h.stake,
-        'result': h.result,
+        'stake': from_nano(h.stake),
+        'result': from_nano(h.result),
         'multiplier': h.multiplier,
         'played_at': h.played_at.strftime('%H:%M:%S'),
         'details': json.loads(h.details) if h.details else {}
     })
 
+@app.route('/api/history/<int:telegram_id>', methods=['GET'])
+def game_history(telegram_id):
+    try:
+        games, next_cursor = keyset_page(
+            db.select(GameHistory.id, GameHistory.game_type, GameHistory.stake, GameHistory.result,
+                      GameHistory.multiplier, GameHistory.details, GameHistory.played_at)
+              .where(GameHistory.user_id == telegram_id), GameHistory.played_at, GameHistory.id)
+    except ValueError:
+        return jsonify({'error': 'Invalid page'}), 400
+    return paged_response([{
+        'id': h.id,
+        'game_type': h.game_type,
+        'stake': from_nano(h.stake),
+        'result': from_nano(h.result),
+        'multiplier': h.multiplier,
+        'played_at': h.played_at.strftime('%d.%m %H:%M:%S'),
+        'details': json.loads(h.details) if h.details else {}
+    } for h in games], next_cursor)
+
+# ── METRICS ──────────────────────────────────────────────────────
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    flush_metrics(force=True)
+    return Response(metrics_store.totals().render(), mimetype='text/plain; version=0.0.4')
+
 # ── STATIC FILES ─────────────────────────────────────────────────
 @app.route('/static/<path:filename>')
 def static_files(filename):
     return send_from_directory('static', filename)
 
 # ── DB INIT ──────────────────────────────────────────────────────
-with app.app_context():
+# db.create_all() only creates missing tables; changes to existing ones go through
+# numbered migrations recorded in schema_version. A fresh database is created at
+# the latest version directly.
+MONEY_COLUMNS = {
+    'user': ['balance', 'total_deposited', 'ref_balance'],
+    'game_history': ['stake', 'result'],
+    'inventory': ['sell_price'],
+    'withdrawal_request': ['amount'],
+    'deposit_record': ['amount'],
+    'ledger_entry': ['delta', 'balance_after'],
+}
+
+def rebuild_sqlite_table(conn, table, convert):
+    """SQLite can't ALTER a column's type: recreate the table from the model and copy rows over.
+
+    `convert` maps column name -> SQL expression over the old column.
+    """
+    old = f'{table.name}__old'
+    old_cols = [c['name'] for c in db.inspect(conn).get_columns(table.name)]
+    for index in db.inspect(conn).get_indexes(table.name):
+        conn.exec_driver_sql(f'DROP INDEX "{index["name"]}"')
+    # Keep other tables' foreign keys pointing at the new table, not the renamed one
+    conn.exec_driver_sql('PRAGMA legacy_alter_table=ON')
+    conn.exec_driver_sql(f'ALTER TABLE "{table.name}" RENAME TO "{old}"')
+    conn.exec_driver_sql('PRAGMA legacy_alter_table=OFF')
+    table.create(conn)
+    cols = [c for c in old_cols if c in table.c]
+    targets = ', '.join(f'"{c}"' for c in cols)
+    sources = ', '.join(convert.get(c, f'"{c}"') for c in cols)
+    conn.exec_driver_sql(f'INSERT INTO "{table.name}" ({targets}) SELECT {sources} FROM "{old}"')
+    conn.exec_driver_sql(f'DROP TABLE "{old}"')
+
+def migrate_money_to_nano(conn):
+    """v1: Float TON amounts -> BigInteger nano-TON"""
+    existing = set(db.inspect(conn).get_table_names())
+    for name, cols in MONEY_COLUMNS.items():
+        if name not in existing:
+            continue
+        if conn.dialect.name == 'sqlite':
+            rebuild_sqlite_table(conn, db.metadata.tables.get(name, legacy_metadata.tables.get(name)),
+                                 {c: f'CAST(ROUND("{c}" * {NANO}) AS INTEGER)' for c in cols})
+        else:
+            for c in cols:
+                conn.exec_driver_sql(f'ALTER TABLE "{name}" ALTER COLUMN "{c}" TYPE BIGINT USING ROUND("{c}" * {NANO})')
+
+def create_missing_indexes(conn):
+    """v2: indexes for the hot per-user and admin lookups"""
+    existing = set(db.inspect(conn).get_table_names())
+    for table in db.metadata.sorted_tables:
+        if table.name in existing:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+    conn.exec_driver_sql('DROP INDEX IF EXISTS ix_notification_status')  # superseded by ix_notification_due
+
+def migrate_inventory_to_stacks(conn):
+    """v3: per-item inventory rows -> gift catalog + per-user quantities"""
+    if not db.inspect(conn).has_table('inventory'):
+        return
+    inv, gift, stack = legacy_inventory, Gift.__table__, Inventory.__table__
+    # Each gift's catalog entry takes the image and price of its most recent row
+    latest = db.select(db.func.max(inv.c.id)).group_by(inv.c.gift_name)
+    known = db.select(gift.c.name)
+    conn.execute(gift.insert().from_select(
+        ['name', 'image', 'sell_price'],
+        db.select(inv.c.gift_name, inv.c.gift_image, inv.c.sell_price)
+          .where(inv.c.id.in_(latest), inv.c.gift_name.is_not(None), inv.c.gift_name.not_in(known))))
+    conn.execute(stack.insert().from_select(
+        ['user_id', 'gift_id', 'quantity', 'obtained_at'],
+        db.select(inv.c.user_id, gift.c.id, db.func.count(),
+                  db.func.coalesce(db.func.max(inv.c.obtained_at), db.func.current_timestamp()))
+          .join(gift, gift.c.name == inv.c.gift_name).where(inv.c.user_id.is_not(None))
+          .group_by(inv.c.user_id, gift.c.id)))
+    legacy_inventory.drop(conn)
+
+def add_referral_counters(conn):
+    """v4: referral aggregates on the referrer's row, backfilled from referees and the ledger.
+
+    Commissions paid before the ledger existed aren't in it, so ref_earned starts at the larger of the
+    ledger's 'ref' credits and the unwithdrawn ref_balance; referral withdrawals from before the ledger
+    can't be recovered and stay uncounted.
+    """
+    user, referee, ledger = User.__table__, User.__table__.alias('referee'), LedgerEntry.__table__
+    existing = {c['name'] for c in db.inspect(conn).get_columns('user')}
+    for column in ('ref_count', 'ref_deposited', 'ref_earned'):
+        if column not in existing:  # v1's table rebuild already creates them
+            kind = 'INTEGER' if column == 'ref_count' else 'BIGINT'
+            conn.exec_driver_sql(f'ALTER TABLE "user" ADD COLUMN {column} {kind} DEFAULT 0')
+    referees = db.select(db.func.count()).where(referee.c.ref_id == user.c.telegram_id)
+    deposited = db.select(db.func.coalesce(db.func.sum(referee.c.total_deposited), 0)) \
+        .where(referee.c.ref_id == user.c.telegram_id)
+    earned = db.select(db.func.coalesce(db.func.sum(ledger.c.delta), 0)) \
+        .where(ledger.c.user_id == user.c.telegram_id, ledger.c.account == 'ref', ledger.c.delta > 0).scalar_subquery()
+    unwithdrawn = db.func.coalesce(user.c.ref_balance, 0)
+    conn.execute(user.update().values(ref_count=referees.scalar_subquery(), ref_deposited=deposited.scalar_subquery(),
+                                      ref_earned=db.case((earned >= unwithdrawn, earned), else_=unwithdrawn)))
+    conn.exec_driver_sql('DROP INDEX IF EXISTS ix_user_ref_id')  # superseded by ix_user_ref_created
+    for index in user.indexes:
+        index.create(conn, checkfirst=True)
+
+def page_inventory_by_stack_id(conn):
+    """v5: inventory pages on the stack id; obtained_at moves when a stack wins the same gift again"""
+    conn.exec_driver_sql('DROP INDEX IF EXISTS ix_inventory_stack_user_obtained')
+    for index in Inventory.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+MIGRATIONS = [
+    (1, migrate_money_to_nano),
+    (2, create_missing_indexes),
+    (3, migrate_inventory_to_stacks),
+    (4, add_referral_counters),
+    (5, page_inventory_by_stack_id),
+]
+
+def migrate_db():
+    with db.engine.begin() as conn:
+        fresh = not db.inspect(conn).has_table('user')
+        conn.exec_driver_sql('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+        version = conn.exec_driver_sql('SELECT version FROM schema_version').scalar()
+        if version is None:
+            version = MIGRATIONS[-1][0] if fresh else 0
+            conn.execute(db.text('INSERT INTO schema_version (version) VALUES (:v)'), {'v': version})
     db.create_all()
+    for number, migration in MIGRATIONS:
+        if number <= version:
+            continue
+        with db.engine.begin() as conn:
+            app.logger.warning('Applying schema migration %d: %s', number, migration.__doc__)
+            without_statement_timeout(conn)  # table rewrites and backfills run as long as they need
+            migration(conn)
+            conn.execute(db.text('UPDATE schema_version SET version = :v'), {'v': number})
+
+# ─── STARTUP ────────────────────────────────────────────────────
+# Importing the module has no side effects on the database and starts no
+# threads. Serving processes call start_background() once: `python app.py`,
+# gunicorn's post_fork hook (gunicorn.conf.py) and the ASGI lifespan. CLI checks
+# and benchmarks call scratch_run() instead.
+def init_db():
+    """Migrate the schema, sync the gift catalog and warm the caches built from the DB"""
+    with app.app_context():
+        migrate_db()
+        sync_gift_catalog()
+        db.session.commit()
+        leaderboard_cache.rebuild()
+        if db.session.get(StatCounter, 'reconciled_at') is None:
+            try:
+                reconcile_stats(force=True)
+            except IntegrityError:  # another worker seeded them first
+                db.session.rollback()
+
+def start_background(notifications=True):
+    """init_db(), then this process's background threads; `notifications=False` when the caller runs its own"""
+    init_db()
+    if os.environ.get('ROLLS_SCHEDULER', '1') != '0':
+        start_rolls_scheduler()
+    if notifications and os.environ.get('NOTIFY_DISPATCHER', '1') != '0':
+        start_notification_dispatcher()
+    if os.environ.get('STATS_RECONCILER', '1') != '0':
+        start_stats_reconciler()
+    start_presence_flusher()
+    start_idempotency_flusher()
+
+def scratch_run(real_db_ok=False):
+    """Set up a CLI check or benchmark: in-process stores (nothing shared with a running server) and the schema"""
+    global rolls_store, user_cache, metrics_store
+    if not real_db_ok and db.engine.url.database not in (None, '', ':memory:'):
+        raise click.ClickException('refusing to run against a real database; set DATABASE_URL=sqlite://')
+    rolls_store, user_cache, metrics_store = MemoryRollsStore(), MemoryUserCache(), MemoryMetricsStore()
+    init_db()
+
+@app.cli.command('audit-commits')
+def audit_commits_command():
+    """Drive every writing endpoint once and fail if any commits more than once.
+
+    Needs a throwaway database: DATABASE_URL=sqlite://
+    """
+    scratch_run()
+    app.config['COMMIT_AUDIT'] = True
+    client = app.test_client()
+    a, b = 900001, 900002
+    sessions = {tid: {'Authorization': f'Bearer {issue_session_token(tid)}'} for tid in (a, b)}
+    client.post('/api/init', json={'init_data': sign_init_data({'id': a, 'first_name': 'Audit'})})
+    client.post('/api/admin/user/update', json={'telegram_id': a, 'balance_add': 1000})
+    rolls_store.set_spin_time(time.time())
+    deposit_id = client.post('/api/deposit/ton', json={'telegram_id': b, 'amount': 10},
+                             headers=sessions[b]).get_json()['deposit_id']
+    with app.app_context():
+        add_to_inventory(a, [{'name': 'Swag Bag'}] * 2, datetime.utcnow())
+        db.session.commit()
+        item_id = db.session.query(Inventory.id).filter_by(user_id=a).scalar()
+    calls = [
+        ('POST', '/api/init', {'init_data': sign_init_data({'id': b, 'first_name': 'Ref'}), 'ref_id': a}),
+        ('POST', '/api/init', {'init_data': sign_init_data({'id': a, 'first_name': 'Audit'})}),
+        ('POST', '/api/gift_upgrade/spin', {'telegram_id': a, 'stake': 1, 'multiplier': 2}),
+        ('POST', '/api/rolls/bet', {'telegram_id': a, 'color': 'red', 'amount': 1}),
+        ('POST', '/api/mutants/open_case', {'telegram_id': a, 'case_type': 'free'}),
+        ('POST', '/api/mutants/open_case', {'telegram_id': a, 'case_type': 'regular'}),
+        ('POST', '/api/inventory/sell', {'telegram_id': a, 'item_id': item_id}),
+        ('POST', '/api/inventory/sell_all', {'telegram_id': a}),
+        ('POST', '/api/deposit/stars', {'telegram_id': b, 'stars': 30000}),
+        ('POST', '/api/deposit/confirm', {'deposit_id': deposit_id}),
+        ('POST', '/api/referrals/withdraw', {'telegram_id': a}),
+        ('POST', '/api/withdraw/create', {'telegram_id': a, 'amount': 10, 'wallet_address': 'UQ-audit'}),
+        ('POST', '/api/admin/withdrawal/1/action', {'action': 'reject'}),
+        ('POST', '/api/admin/user/update', {'telegram_id': a, 'balance_set': 5, 'ref_percent': 15}),
+        ('POST', '/api/deposit/stars', {'telegram_id': a, 'stars': 100}, {'Idempotency-Key': 'audit'}),
+        ('POST', '/api/deposit/stars', {'telegram_id': a, 'stars': 100}, {'Idempotency-Key': 'audit'}),  # replay
+    ]
+    failed = False
+    for method, path, body, *extra in calls:
+        headers = dict(sessions.get(body.get('telegram_id'), {}), **(extra[0] if extra else {}))
+        resp = client.open(path, method=method, json=body, headers=headers)
+        commits = int(resp.headers.get('X-DB-Commits', 0))
+        ok = commits <= MAX_COMMITS_PER_REQUEST
+        failed |= not ok
+        click.echo(f"{'ok  ' if ok else 'FAIL'} {commits} commit(s)  {method} {path}  [{resp.status_code}]")
+    if failed:
+        raise SystemExit(1)
+
+def hot_queries():
+    """The lookups endpoints run on every call, as the routes issue them"""
+    tid, since = 900001, datetime.utcnow() - timedelta(hours=24)
+    return {
+        'last_game / admin_get_user history': db.select(GameHistory).filter_by(user_id=tid)
+            .order_by(GameHistory.played_at.desc()).limit(20),
+        'history page': db.select(GameHistory).filter_by(user_id=tid)
+            .where(db.tuple_(GameHistory.played_at, GameHistory.id) < (since, 1000))
+            .order_by(GameHistory.played_at.desc(), GameHistory.id.desc()).limit(PAGE_SIZE + 1),
+        'inventory page': db.select(Inventory.id, Inventory.quantity, Gift.name, Gift.sell_price)
+            .join(Gift, Gift.id == Inventory.gift_id).where(Inventory.user_id == tid, Inventory.quantity > 0)
+            .where(db.tuple_(Inventory.id) < (1000,)).order_by(Inventory.id.desc()).limit(PAGE_SIZE + 1),
+        'referee page': db.select(User.id, User.first_name, User.username, User.total_deposited, User.created_at)
+            .where(User.ref_id == tid).where(db.tuple_(User.created_at, User.id) < (since, 1000))
+            .order_by(User.created_at.desc(), User.id.desc()).limit(PAGE_SIZE + 1),
+        'admin_stats online buckets': db.select(OnlineBucket).where(OnlineBucket.minute > epoch_minute(since)),
+        'stats reconcile online': db.select(User.last_online).where(User.last_online >= since),
+        'admin_pending_withdrawals': db.select(WithdrawalRequest).filter_by(status='pending')
+            .order_by(WithdrawalRequest.created_at.desc()),
+        'withdrawals page': db.select(WithdrawalRequest).filter_by(user_id=tid)
+            .order_by(WithdrawalRequest.created_at.desc(), WithdrawalRequest.id.desc()).limit(PAGE_SIZE + 1),
+        'leaderboard rebuild': db.select(User).order_by(User.total_deposited.desc()).limit(100),
+        'user by telegram_id': db.select(User).filter_by(telegram_id=tid),
+        'notification claim': db.select(Notification.id).where(Notification.status == 'pending',
+                                                               Notification.next_attempt_at <= since)
+            .order_by(Notification.next_attempt_at).limit(NOTIFY_BATCH_SIZE),
+        'idempotency key eviction': db.select(IdempotencyKey.user_id).where(IdempotencyKey.expires_at < since),
+    }
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Seed a throwaway SQLite DB and fail if any hot query plans a full scan or a sort.
+
+    DATABASE_URL=sqlite://
+    """
+    scratch_run()
+    now = datetime.utcnow()
+    db.session.add_all(User(telegram_id=900000 + i, first_name=f'user{i}', ref_id=900000 + i // 10,
+                            total_deposited=i * NANO, last_online=now - timedelta(minutes=i))
+                       for i in range(500))
+    for i in range(5000):
+        tid, at = 900000 + i % 500, now - timedelta(seconds=i)
+        db.session.add(GameHistory(user_id=tid, game_type='gift_upgrade', stake=NANO, result=-NANO, played_at=at))
+        if i < 2500:  # five gift stacks per user
+            db.session.add(Inventory(user_id=tid, gift_id=1 + i // 500, quantity=i % 7, obtained_at=at))
+        if i % 10 == 0:
+            db.session.add(WithdrawalRequest(user_id=tid, amount=10 * NANO, wallet_address='UQ',
+                                             status=('pending', 'approved', 'rejected')[i % 3], created_at=at))
+            db.session.add(Notification(chat_id=str(tid), text='seed', status='sent', next_attempt_at=at))
+    db.session.commit()
+    failed = False
+    for name, stmt in hot_queries().items():
+        sql = str(stmt.compile(db.engine, compile_kwargs={'literal_binds': True}))
+        plan = [row[3] for row in db.session.execute(db.text(f'EXPLAIN QUERY PLAN {sql}'))]
+        bad = [step for step in plan if (step.startswith('SCAN ') and ' INDEX ' not in step) or 'TEMP B-TREE' in step]
+        failed |= bool(bad)
+        click.echo(f"{'FAIL' if bad else 'ok  '} {name}: {'; '.join(plan)}")
+    if failed:
+        raise SystemExit(1)
+
+@app.cli.command('check-dispatcher')
+def check_dispatcher_command():
+    """Run one dispatcher pass against a stub Bot API and fail if any reply is handled wrong.
+
+    DATABASE_URL=sqlite://
+    """
+    scratch_run()
+    retry_after = 7
+    replies = {  # chat_id -> the stub's answer; 429 goes last so its pause doesn't hold up the rest
+        '1': (200, {'ok': True, 'result': {}}),
+        '2': (400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: chat not found'}),
+        '3': (403, {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'}),
+        '4': (500, {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'}),
+        '5': (429, {'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {retry_after}',
+                    'parameters': {'retry_after': retry_after}}),
+    }
+    posts = []
+
+    class StubBotAPI(BaseHTTPRequestHandler):
+        def do_POST(self):
+            message = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            posts.append(message)
+            status, reply = replies[message['chat_id']]
+            payload = json.dumps(reply).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    for chat_id in replies:
+        send_telegram_message(chat_id, f'check {chat_id}')
+    send_telegram_message('1', 'check 1 again')
+    db.session.commit()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubBotAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    dispatcher = TelegramDispatcher(api_url=f'http://127.0.0.1:{server.server_port}', token='check')
+    dispatcher.http.trust_env = False  # no proxy between us and the stub
+    started = datetime.utcnow()
+    try:
+        dispatcher.run_once()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    rows = {}
+    for row in db.session.query(Notification).order_by(Notification.id):
+        rows.setdefault(row.chat_id, []).append(row)
+
+    def due_in(row):
+        return (row.next_attempt_at - started).total_seconds()
+
+    to_one = [p for p in posts if p['chat_id'] == '1']
+    checks = [
+        ('two messages to one chat go out as one sendMessage',
+         len(to_one) == 1 and to_one[0]['text'] == 'check 1\n\ncheck 1 again'),
+        ('200: both merged rows sent', all(r.status == 'sent' and r.attempts == 1 for r in rows['1'])),
+        ('400: failed, not retried', rows['2'][0].status == 'failed'),
+        ('403: failed, not retried', rows['3'][0].status == 'failed'),
+        ('5xx: pending with backoff', rows['4'][0].status == 'pending' and rows['4'][0].attempts == 1
+         and 5 * 2 ** 1 - 1 <= due_in(rows['4'][0]) <= 5 * 2 ** 1 + 2),
+        (f'429: pending until retry_after ({retry_after} s)', rows['5'][0].status == 'pending'
+         and retry_after - 1 <= due_in(rows['5'][0]) <= retry_after + 2),
+        ('429: dispatcher paused', dispatcher.send_delay('6') > retry_after - 2),
+    ]
+    dispatcher.last_sent_to = {'quiet': time.monotonic() - 2 * TELEGRAM_CHAT_INTERVAL, 'recent': time.monotonic()}
+    dispatcher.cleanup(db.session)
+    checks.append(('cleanup forgets chats past the per-chat delay', list(dispatcher.last_sent_to) == ['recent']))
+    failed = False
+    for name, ok in checks:
+        failed |= not ok
+        click.echo(f"{'ok  ' if ok else 'FAIL'} {name}")
+    if failed:
+        raise SystemExit(1)
+
+@app.cli.command('bench-auth')
+@click.option('-n', '--iterations', default=20000, show_default=True)
+def bench_auth_command(iterations):
+    """Time each auth path and the per-request overhead require_session adds, in µs per call"""
+    tid = 900001
+    init_data = sign_init_data({'id': tid, 'first_name': 'Bench'})
+    token = issue_session_token(tid)
+    body = {'telegram_id': tid}
+    headers = {'Authorization': f'Bearer {token}'}
+    guarded = require_session(lambda: None)
+
+    def per_call(fn):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        return (time.perf_counter() - start) / iterations * 1e6
+
+    def in_request(view):
+        with app.test_request_context('/', method='POST', json=body, headers=headers):
+            return per_call(view)
+
+    verify_session_token(token)  # warm the verified-token cache
+    bare = in_request(lambda: None)
+    results = [
+        ('initData HMAC check (once, in /api/init)', per_call(lambda: verify_init_data(init_data))),
+        ('token issue (once, in /api/init)', per_call(lambda: issue_session_token(tid))),
+        ('token signature check (cache miss)', per_call(lambda: check_session_signature(token))),
+        ('token cache hit', per_call(lambda: verify_session_token(token))),
+        ('require_session per request (cache hit)', in_request(guarded) - bare),
+    ]
+    for name, micros in results:
+        click.echo(f'{micros:8.2f} µs  {name}')
+
+# Request mixes for bench-load: (weight, request builder), the builder gets (rng, telegram_id)
+BENCH_MIXES = {
+    'rolls': [
+        (8, lambda rng, tid: ('GET', '/api/rolls/state', None)),
+        (2, lambda rng, tid: ('POST', '/api/rolls/bet', {'telegram_id': tid, 'color': rng.choice(['red', 'blue', 'green']),
+                                                         'amount': 1})),
+    ],
+    'spins': [
+        (3, lambda rng, tid: ('POST', '/api/gift_upgrade/spin', {'telegram_id': tid, 'stake': 1,
+                                                                 'multiplier': rng.choice([1.3, 2, 5])})),
+        (1, lambda rng, tid: ('POST', '/api/gift_upgrade/spin', {'telegram_id': tid, 'stake': 1, 'multiplier': 2,
+                                                                 'count': 10})),
+        (2, lambda rng, tid: ('POST', '/api/mutants/open_case', {'telegram_id': tid, 'case_type': 'regular'})),
+    ],
+    'deposits': [
+        (1, lambda rng, tid: ('POST', '/api/deposit/stars', {'telegram_id': tid, 'stars': rng.choice([100, 500, 2500])})),
+    ],
+    'leaderboard': [
+        (1, lambda rng, tid: ('GET', '/api/leaderboard', None)),
+    ],
+}
+BENCH_MIXES['mixed'] = [entry for mix in BENCH_MIXES.values() for entry in mix]
+
+def bench_seed(users, history, inventory):
+    """Bulk-insert a referral tree of rich, unlocked users with game history and inventory stacks"""
+    now = datetime.utcnow()
+    first = 900000
+    db.session.execute(db.insert(User), [
+        {'telegram_id': first + i, 'first_name': f'user{i}', 'ref_id': first + i // 10 if i >= 10 else None,
+         'balance': 10**6 * NANO, 'total_deposited': (i % 1000) * NANO, 'created_at': now, 'last_online': now}
+        for i in range(users)])
+    db.session.execute(db.insert(GameHistory), [
+        {'user_id': first + i % users, 'game_type': 'gift_upgrade', 'stake': NANO, 'result': -NANO,
+         'played_at': now - timedelta(seconds=i)} for i in range(history)])
+    gifts = list(gift_ids.values())
+    stacks = {(first + i % users, gifts[i % len(gifts)]) for i in range(inventory)}
+    db.session.execute(db.insert(Inventory), [
+        {'user_id': tid, 'gift_id': gift_id, 'quantity': 3, 'obtained_at': now} for tid, gift_id in stacks])
+    db.session.commit()
+    return [first + i for i in range(users)]
+
+def percentile(samples, p):
+    """Nearest-rank percentile of a sorted list"""
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+def bench_run(mix, tids, requests_total, concurrency, seed):
+    """Drive `mix` from `concurrency` threads; returns {endpoint: stats} and the wall time"""
+    weights = [w for w, _ in mix]
+    tokens = {tid: {'Authorization': f'Bearer {issue_session_token(tid)}'} for tid in tids}
+    samples, lock = {}, threading.Lock()
+
+    def worker(n, wseed):
+        rng, client = random.Random(wseed), app.test_client()
+        for _ in range(n):
+            tid = rng.choice(tids)
+            method, path, body = rng.choices(mix, weights)[0][1](rng, tid)
+            start = time.perf_counter()
+            resp = client.open(path, method=method, json=body, headers=tokens[tid])
+            elapsed = time.perf_counter() - start
+            commits = int(resp.headers.get('X-DB-Commits', 0))
+            with lock:
+                samples.setdefault(f'{method} {path}', []).append((elapsed, commits, resp.status_code >= 400))
+
+    per_thread = max(requests_total // concurrency, 1)
+    threads = [threading.Thread(target=worker, args=(per_thread, seed + i)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+    stats = {}
+    for endpoint, rows in sorted(samples.items()):
+        latencies = sorted(r[0] * 1000 for r in rows)
+        stats[endpoint] = {
+            'requests': len(rows), 'errors': sum(r[2] for r in rows),
+            'p50_ms': round(percentile(latencies, 50), 3), 'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3), 'rps': round(len(rows) / wall, 1),
+            'commits_per_request': round(sum(r[1] for r in rows) / len(rows), 3),
+        }
+    return stats, wall
+
+def bench_regressions(results, baseline, tolerance):
+    """Endpoints whose median latency grew past the tolerance or that commit more often than the baseline.
+
+    Tail latencies under contention swing run to run, so only p50 is compared (with a 0.5 ms floor).
+    """
+    found = []
+    for mix, endpoints in baseline.get('results', {}).items():
+        for endpoint, base in endpoints.items():
+            now = results.get(mix, {}).get(endpoint)
+            if now is None:
+                continue
+            if now['p50_ms'] > base['p50_ms'] * (1 + tolerance) + 0.5:
+                found.append(f"{mix} {endpoint}: p50 {base['p50_ms']} -> {now['p50_ms']} ms")
+            if now['commits_per_request'] > base['commits_per_request'] + 0.01:
+                found.append(f"{mix} {endpoint}: commits/request {base['commits_per_request']} -> {now['commits_per_request']}")
+    return found
+
+@app.cli.command('bench-load')
+@click.option('--users', default=1000, show_default=True)
+@click.option('--history', default=20000, show_default=True, help='game_history rows to seed')
+@click.option('--inventory', default=5000, show_default=True, help='inventory stacks to seed')
+@click.option('--requests', 'requests_total', default=2000, show_default=True, help='requests per mix')
+@click.option('--concurrency', default=8, show_default=True, help='client threads')
+@click.option('--mix', 'mixes', multiple=True, type=click.Choice(list(BENCH_MIXES)), help='default: all')
+@click.option('--seed', default=1, show_default=True)
+@click.option('--baseline', type=click.Path(dir_okay=False), help='compare against this baseline JSON')
+@click.option('--save-baseline', type=click.Path(dir_okay=False), help='write the results here')
+@click.option('--tolerance', default=0.5, show_default=True, help='allowed p50 growth over the baseline')
+def bench_load_command(users, history, inventory, requests_total, concurrency, mixes, seed, baseline, save_baseline,
+                       tolerance):
+    """Seed an empty database and report per-endpoint latency, throughput and commits per request.
+
+    Runs in-process against DATABASE_URL; use a throwaway file DB for concurrency > 1, e.g.
+    DATABASE_URL=sqlite:////tmp/bench.db
+    """
+    scratch_run(real_db_ok=True)
+    in_memory = db.engine.url.database in (None, '', ':memory:')
+    if in_memory and concurrency > 1:
+        raise click.ClickException('an in-memory SQLite DB is one shared connection; use a file DB or --concurrency 1')
+    if db.session.query(User.id).first() is not None:
+        raise click.ClickException('refusing to run against a database that already has users')
+    app.config['COMMIT_AUDIT'] = True
+    click.echo(f'seeding {users} users, {history} history rows, {inventory} inventory stacks')
+    tids = bench_seed(users, history, inventory)
+    leaderboard_cache.rebuild()
+    results = {}
+    for i, mix in enumerate(mixes or BENCH_MIXES):
+        if 'rolls-scheduler' not in background_threads:
+            rolls_store.set_spin_time(time.time())  # keep the betting window open
+        results[mix], wall = bench_run(BENCH_MIXES[mix], tids, requests_total, concurrency, seed * 1000 + i * 100)
+        total = sum(s['requests'] for s in results[mix].values())
+        click.echo(f'\n{mix}: {total} requests in {wall:.2f} s, {total / wall:.0f} req/s, concurrency {concurrency}')
+        click.echo(f"  {'endpoint':34} {'n':>6} {'err':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8} {'commits':>8}")
+        for endpoint, s in results[mix].items():
+            click.echo(f"  {endpoint:34} {s['requests']:6} {s['errors']:5} {s['p50_ms']:8.2f} {s['p95_ms']:8.2f} "
+                       f"{s['p99_ms']:8.2f} {s['rps']:8.1f} {s['commits_per_request']:8.3f}")
+    params = {'users': users, 'history': history, 'inventory': inventory, 'requests': requests_total,
+              'concurrency': concurrency, 'seed': seed, 'database': db.engine.url.get_backend_name()}
+    if save_baseline:
+        with open(save_baseline, 'w') as f:
+            json.dump({'params': params, 'results': results}, f, indent=2, sort_keys=True)
+        click.echo(f'\nbaseline written to {save_baseline}')
+    if baseline:
+        with open(baseline) as f:
+            base = json.load(f)
+        if base.get('params') != params:
+            click.echo(f"\nwarning: baseline was recorded with {base.get('params')}")
+        regressions = bench_regressions(results, base, tolerance)
+        for line in regressions:
+            click.echo(f'REGRESSION {line}')
+        if regressions:
+            raise SystemExit(1)
+        click.echo(f'\nno regressions against {baseline}')
+
+@app.cli.command('bench-db')
+@click.option('--writers', default=8, show_default=True, help='threads running balance-update transactions')
+@click.option('--readers', default=4, show_default=True, help='threads running aggregate reads')
+@click.option('--seconds', default=5.0, show_default=True, help='run time per profile')
+def bench_db_command(writers, readers, seconds):
+    """Concurrent write/read throughput on a scratch SQLite file, SQLAlchemy defaults vs. the DB profile"""
+    workdir = tempfile.mkdtemp(prefix='bench-db-')
+    tables = [User.__table__, LedgerEntry.__table__]
+    user = User.__table__
+    for name, tuned in (('defaults', False), ('db profile', True)):
+        url = f'sqlite:///{os.path.join(workdir, name.replace(" ", "_"))}.db'
+        engine = db.create_engine(url, **(engine_options(url) if tuned else {}))
+        if tuned:
+            configure_engine(engine)
+        db.metadata.create_all(engine, tables=tables)
+        with engine.begin() as conn:
+            conn.execute(db.insert(user), [{'telegram_id': i, 'balance': 0, 'total_deposited': 0} for i in range(100)])
+        deadline = time.perf_counter() + seconds
+        lock, latencies, counts = threading.Lock(), [], {'writes': 0, 'errors': 0, 'reads': 0}
+
+        def write_loop(seed):
+            rng = random.Random(seed)
+            while time.perf_counter() < deadline:
+                tid, start = rng.randrange(100), time.perf_counter()
+                try:
+                    with engine.begin() as conn:  # read-then-write, like the handlers
+                        conn.execute(db.select(user.c.balance).where(user.c.telegram_id == tid)).scalar()
+                        balance = conn.execute(user.update().where(user.c.telegram_id == tid)
+                                               .values(balance=user.c.balance + 1).returning(user.c.balance)).scalar()
+                        conn.execute(db.insert(LedgerEntry.__table__).values(user_id=tid, delta=1, balance_after=balance,
+                                                                             reason='bench'))
+                except OperationalError:
+                    with lock:
+                        counts['errors'] += 1
+                    continue
+                with lock:
+                    counts['writes'] += 1
+                    latencies.append(time.perf_counter() - start)
+
+        def read_loop():
+            while time.perf_counter() < deadline:
+                try:
+                    with engine.connect() as conn:
+                        conn.execute(db.select(db.func.sum(user.c.balance))).scalar()
+                except OperationalError:
+                    continue
+                with lock:
+                    counts['reads'] += 1
+
+        threads = [threading.Thread(target=write_loop, args=(i,)) for i in range(writers)] + \
+                  [threading.Thread(target=read_loop) for _ in range(readers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        engine.dispose()
+        latencies.sort()
+        p99 = percentile(latencies, 99) * 1000 if latencies else 0
+        click.echo(f"{name:12} {counts['writes'] / seconds:8.0f} writes/s  {counts['errors']:5} failed  "
+                   f"p99 {p99:8.1f} ms  {counts['reads'] / seconds:8.0f} reads/s")
+    shutil.rmtree(workdir, ignore_errors=True)
+
+SERVING_MODES = {
+    'wsgi': lambda port, workers, threads: [sys.executable, '-m', 'gunicorn', '-k', 'gthread', '-w', str(workers),
+                                            '--threads', str(threads), '-b', f'127.0.0.1:{port}', 'app:app'],
+    'asgi': lambda port, workers, threads: [sys.executable, '-m', 'uvicorn', 'asgi:app', '--workers', str(workers),
+                                            '--port', str(port), '--log-level', 'warning'],
+}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def open_streams(port, count, wait):
+    """Opens `count` Rolls streams; returns (sockets, how many got a 200 within `wait` seconds)"""
+    sel, socks, answered = selectors.DefaultSelector(), [], 0
+    for i in range(count):
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.sendall(f'GET /api/rolls/stream?telegram_id={i} HTTP/1.1\r\nHost: bench\r\n\r\n'.encode())
+        sock.setblocking(False)
+        sel.register(sock, selectors.EVENT_READ)
+        socks.append(sock)
+    deadline = time.monotonic() + wait
+    while answered < count and time.monotonic() < deadline:
+        for key, _ in sel.select(deadline - time.monotonic()):
+            sel.unregister(key.fileobj)
+            answered += key.fileobj.recv(64).startswith(b'HTTP/1.1 200')  # 503 once past the per-worker cap
+    sel.close()
+    return socks, answered
+
+@app.cli.command('bench-serving')
+@click.option('--streams', default=300, help='Rolls streams held open during the run')
+@click.option('--requests', 'total', default=2000, help='/api/rolls/state polls')
+@click.option('--concurrency', default=50)
+@click.option('--workers', default=2, help='server processes per mode')
+@click.option('--threads', default=32, help='gthread threads per gunicorn worker')
+@click.option('--stream-wait', default=5.0, help='seconds a stream may take to start')
+def bench_serving_command(streams, total, concurrency, workers, threads, stream_wait):
+    """gunicorn gthread vs. uvicorn asgi:app under many open streams; needs requirements-asgi.txt"""
+    workdir = tempfile.mkdtemp(prefix='bench-serving-')
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{workdir}/bench.db', ROLLS_STORE='memory', USER_CACHE='memory',
+               METRICS_STORE=f'sqlite:///{workdir}/metrics.db',
+               ROLLS_SCHEDULER='1', NOTIFY_DISPATCHER='0', STATS_RECONCILER='0', TELEGRAM_AUTH='0')
+    here = os.path.dirname(os.path.abspath(__file__))
+    subprocess.run([sys.executable, '-c', 'import app; app.init_db()'], cwd=here, env=env, check=True)  # schema before workers race for it
+    for mode, command in SERVING_MODES.items():
+        port = free_port()
+        server = subprocess.Popen(command(port, workers, threads), cwd=here, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        url = f'http://127.0.0.1:{port}/api/rolls/state'
+        socks = []
+        try:
+            for _ in range(100):
+                try:
+                    if requests.get(url, timeout=1).ok:
+                        break
+                except requests.RequestException:
+                    pass
+                time.sleep(0.2)
+            else:
+                raise click.ClickException(f'{mode} server did not start: {" ".join(command(port, workers, threads))}')
+            socks, answered = open_streams(port, streams, stream_wait)
+
+            def poll(_):
+                start = time.perf_counter()
+                try:
+                    ok = requests.get(url, timeout=10).ok
+                except requests.RequestException:
+                    ok = False
+                return ok, time.perf_counter() - start
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(concurrency) as pool:
+                results = list(pool.map(poll, range(total)))
+            elapsed = time.perf_counter() - started
+        finally:
+            for sock in socks:
+                sock.close()
+            server.terminate()
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        latencies = sorted(t for ok, t in results if ok)
+        errors = len(results) - len(latencies)
+        p = [percentile(latencies, q) * 1000 if latencies else 0 for q in (50, 95, 99)]
+        click.echo(f'{mode}  streams {answered:5}/{streams} started  polls {len(latencies) / elapsed:7.0f} req/s  '
+                   f'p50 {p[0]:7.1f}  p95 {p[1]:7.1f}  p99 {p[2]:7.1f} ms  {errors:5} failed')
+    shutil.rmtree(workdir, ignore_errors=True)
 
 if __name__ == '__main__':
+    start_background()
     app.run(host='0.0.0.0', port=5000, debug=True)
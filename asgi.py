@@ -0,0 +1,248 @@
+"""ASGI serving mode: `uvicorn asgi:app --workers 4`.
+
+The I/O-bound paths run on the event loop: Rolls state and the SSE stream
+(no thread is held per subscriber), TON deposit confirmation (async DB
+driver) and the notification dispatcher (async DB + HTTP). Every other route
+is the Flask app run on a thread pool, so URLs and payloads are the same as
+under `gunicorn app:app`. Needs the packages in requirements-asgi.txt.
+"""
+import os, json, time, asyncio
+from urllib.parse import parse_qs
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import Session
+
+import app as wsgi
+
+ASYNC_NOTIFY = os.environ.get('NOTIFY_DISPATCHER', '1') != '0'  # the async dispatcher below replaces app.py's thread
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 32))  # threads for the routes Flask still serves
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+
+def async_engine_args(url):
+    """(async URL, create_async_engine options) for the app's DATABASE_URL"""
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError(f'no async driver configured for {backend}')
+    if backend == 'sqlite' and url.database in (None, '', ':memory:'):
+        raise RuntimeError('the ASGI mode needs a database file or server; in-memory SQLite is per connection')
+    options = wsgi.engine_options(url) if wsgi.DB_PROFILE else {}
+    if backend == 'postgresql' and 'connect_args' in options:  # asyncpg takes server settings, not libpq options
+        options['connect_args'] = {'server_settings': {'statement_timeout': str(wsgi.DB_STATEMENT_TIMEOUT_MS)}}
+    return url.set(drivername=ASYNC_DRIVERS[backend]), options
+
+class AsyncPathSession(Session):
+    """Sync side of the async sessions; drops changed users' cached views on commit like db.session"""
+
+event.listen(AsyncPathSession, 'after_commit', wsgi.invalidate_changed_users)
+event.listen(AsyncPathSession, 'after_rollback', wsgi.forget_changed_users)
+
+async def read_json(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    try:
+        return json.loads(b''.join(chunks) or b'null')
+    except ValueError:
+        return None
+
+async def send_json(send, status, data):
+    body = json.dumps(data).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+class AsyncRollsFeed:
+    """Wakes stream coroutines when app.py publishes a round; the publisher is a plain thread"""
+    def __init__(self):
+        self.loop = None
+        self.changed = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+        wsgi.rolls_feed_listeners.append(self.notify)
+
+    def stop(self):
+        wsgi.rolls_feed_listeners.remove(self.notify)
+
+    def notify(self):
+        self.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def wait(self, version, timeout):
+        """Until the feed moves past `version`, or `timeout` seconds"""
+        if wsgi.rolls_feed['version'] != version:
+            return
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+class AsyncTelegramDispatcher(wsgi.TelegramDispatcher):
+    """The thread dispatcher's claim/coalesce/settle steps, on the event loop"""
+    def __init__(self, sessions):
+        super().__init__()
+        self.sessions = sessions
+        self.client = httpx.AsyncClient(timeout=10, limits=httpx.Limits(max_connections=4))
+
+    async def in_session(self, fn, *args):
+        async with self.sessions() as session:
+            return await session.run_sync(fn, *args)
+
+    async def post_async(self, chat_id, text):
+        wait = self.send_delay(chat_id)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self.last_sent = self.last_sent_to[chat_id] = time.monotonic()
+        try:
+            resp = await self.client.post(f'{self.api_url}/bot{self.token}/sendMessage',
+                                          json={'chat_id': chat_id, 'text': text, 'parse_mode': 'HTML'})
+            body = resp.json()
+        except (httpx.HTTPError, ValueError) as e:
+            raise wsgi.TelegramSendError(str(e))
+        finally:
+            wsgi.metrics.observe('outbound_http_seconds', (('target', 'telegram'),), time.monotonic() - self.last_sent)
+        self.check_response(resp.status_code, body)
+
+    async def run_once_async(self):
+        rows = await self.in_session(self.claim)
+        for batch in self.coalesce(rows):
+            try:
+                await self.post_async(batch['chat_id'], batch['text'][:wsgi.TELEGRAM_MAX_TEXT])
+            except wsgi.TelegramSendError as e:
+                await self.in_session(self.settle, batch, e)
+            else:
+                await self.in_session(self.settle, batch)
+        if self.cleanup_due():
+            await self.in_session(self.cleanup)
+        return len(rows)
+
+    async def run_forever(self):
+        while True:
+            try:
+                handled = await self.run_once_async()
+            except Exception:
+                wsgi.app.logger.exception('Notification dispatch failed')
+                handled = 0
+            if handled < wsgi.NOTIFY_BATCH_SIZE:
+                await asyncio.sleep(wsgi.NOTIFY_POLL_SECONDS)
+
+class AsyncApp:
+    """ASGI callable: async handlers for the routes in `self.routes`, the Flask app for the rest"""
+    def __init__(self):
+        with wsgi.app.app_context():
+            url, options = async_engine_args(wsgi.db.engine.url)
+        self.engine = create_async_engine(url, **options)
+        if wsgi.DB_PROFILE:
+            wsgi.configure_engine(self.engine.sync_engine)
+        self.sessions = async_sessionmaker(self.engine, sync_session_class=AsyncPathSession, expire_on_commit=False)
+        self.flask = WSGIMiddleware(wsgi.app, workers=ASGI_WSGI_THREADS)
+        self.feed = AsyncRollsFeed()
+        self.dispatcher = AsyncTelegramDispatcher(self.sessions) if ASYNC_NOTIFY else None
+        self.background = []
+        self.routes = {
+            ('GET', '/api/rolls/state'): self.rolls_state,
+            ('GET', '/api/rolls/stream'): self.rolls_stream,
+            ('POST', '/api/deposit/confirm'): self.confirm_deposit,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        handler = self.routes.get((scope.get('method'), scope['path'])) if scope['type'] == 'http' else None
+        if handler is None:
+            return await self.flask(scope, receive, send)
+        started = time.perf_counter()
+        status = await handler(scope, receive, send)
+        wsgi.metrics.record_request(scope['path'], scope['method'], status, time.perf_counter() - started, 0, 0.0, 0, 0.0)
+        if time.monotonic() - wsgi.metrics_flushed_at >= wsgi.METRICS_FLUSH_SECONDS:
+            await asyncio.to_thread(wsgi.flush_metrics)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.feed.start()
+                await asyncio.to_thread(wsgi.start_background, notifications=False)
+                if self.dispatcher is not None:
+                    self.background.append(asyncio.create_task(self.dispatcher.run_forever()))
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.feed.stop()
+                for task in self.background:
+                    task.cancel()
+                await asyncio.gather(*self.background, return_exceptions=True)  # let them release their connections
+                if self.dispatcher is not None:
+                    await self.dispatcher.client.aclose()
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def rolls_snapshot(self):
+        if 'rolls-scheduler' in wsgi.background_threads and wsgi.rolls_feed['state'] is not None:
+            return wsgi.rolls_feed['state']  # this worker's scheduler keeps the feed current
+        return await asyncio.to_thread(wsgi.rolls_store.snapshot)
+
+    async def rolls_state(self, scope, receive, send):
+        state = await self.rolls_snapshot()
+        await send_json(send, 200, dict(wsgi.rolls_public_state(state), last_payouts=state['last_payouts']))
+        return 200
+
+    async def rolls_stream(self, scope, receive, send):
+        """Same events as the Flask route; a subscriber costs a coroutine, not a worker thread"""
+        try:
+            uid = str(int(parse_qs(scope['query_string'].decode()).get('telegram_id', [''])[0]))
+        except ValueError:
+            uid = str(None)
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no')]})
+        disconnected = asyncio.ensure_future(receive())  # the next message on an open request is the disconnect
+        try:
+            await send({'type': 'http.response.body', 'body': b'retry: 2000\n\n', 'more_body': True})
+            version = None
+            deadline = time.time() + wsgi.ROLLS_STREAM_MAX_SECONDS
+            while time.time() < deadline and not disconnected.done():
+                if 'rolls-scheduler' not in wsgi.background_threads:
+                    wsgi.refresh_rolls_feed(await asyncio.to_thread(wsgi.rolls_store.snapshot))
+                await self.feed.wait(version, 1.0)
+                latest, state = wsgi.rolls_feed['version'], wsgi.rolls_feed['state']
+                if state is None:
+                    continue
+                chunk, version = wsgi.rolls_stream_event(uid, version, latest, state)
+                await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})  # ignored by the server after a disconnect
+        except OSError:  # client went away mid-write
+            pass
+        finally:
+            disconnected.cancel()
+        return 200
+
+    async def confirm_deposit(self, scope, receive, send):
+        data = await read_json(receive)
+        if not isinstance(data, dict):
+            await send_json(send, 400, {'error': 'Invalid JSON'})
+            return 400
+        async with self.sessions() as session:
+            body, status, depositor = await session.run_sync(wsgi.settle_deposit, data.get('deposit_id'))
+            if depositor is None:
+                await session.rollback()
+            else:
+                await session.commit()
+                wsgi.leaderboard_cache.record(depositor)
+        await send_json(send, status, body)
+        return status
+
+def create_asgi_app():
+    return AsyncApp()
+
+app = create_asgi_app()
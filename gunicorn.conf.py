@@ -0,0 +1,6 @@
+"""Read by gunicorn from the working directory: `gunicorn -w 4 -k gthread --threads 32 app:app`."""
+
+def post_fork(server, worker):
+    """Each worker migrates (no-op once done) and starts its own background threads"""
+    import app
+    app.start_background()
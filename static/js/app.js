@@ -19,6 +19,31 @@ function showToast(msg, type='') {
   toastTimeout = setTimeout(() => t.classList.remove('show'), 2800);
 }
 
+// Session token from /api/init, sent with every call that acts for this user
+function apiHeaders() {
+  let headers = {'Content-Type':'application/json'};
+  if (USER?.session_token) headers['Authorization'] = 'Bearer ' + USER.session_token;
+  return headers;
+}
+
+// Money-moving POST: retries on network errors and 409 with the same Idempotency-Key,
+// so the server runs it once and replays its response. When the outcome can't be
+// replayed (still running after the last try, or 410) the balance is reloaded instead.
+async function postOnce(path, body, attempts = 3) {
+  let key = crypto.randomUUID ? crypto.randomUUID() : Date.now() + '-' + Math.random().toString(36).slice(2);
+  let headers = Object.assign(apiHeaders(), {'Idempotency-Key': key});
+  for (let i = 1; ; i++) {
+    try {
+      let res = await fetch(API + path, { method:'POST', headers, body: JSON.stringify(body) });
+      if (res.status === 410 || (res.status === 409 && i >= attempts)) refreshBalance();
+      if (res.status !== 409 || i >= attempts) return res;
+    } catch(e) {
+      if (i >= attempts) throw e;
+    }
+    await new Promise(r => setTimeout(r, 1000 * i));
+  }
+}
+
 // ─── INIT ───────────────────────────────────────────────────────
 async function initApp() {
   // Try Telegram WebApp SDK
@@ -29,6 +54,7 @@ async function initApp() {
     tg.enableClosingConfirmation();
     let user = tg.initData ? JSON.parse(decodeURIComponent(tg.initData.split('user=')[1]?.split('&')[0] || '{}')) : {};
     initData = {
+      init_data: tg.initData,  // signed by Telegram; the server takes the user from it
       telegram_id: user.id || tg.initDataUnsafe?.user?.id || 12345,
       first_name: user.first_name || tg.initDataUnsafe?.user?.first_name || 'Demo',
       last_name: user.last_name || '',
@@ -51,6 +77,7 @@ async function initApp() {
 
   try {
     let res = await fetch(API + '/api/init', { method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify(initData) });
+    if (!res.ok) throw new Error('init failed');  // e.g. initData rejected: fall back to demo
     USER = await res.json();
   } catch(e) {
     // Offline demo mode
@@ -62,7 +89,6 @@ async function initApp() {
   buildRouletteWheel(1.3); // default
   buildMultiplierButtons();
   buildRollsChips();
-  startRollsPolling();
   loadFreeTimerStatus();
 }
 
@@ -96,17 +122,24 @@ function updateProfilePage() {
 
 async function loadInventory() {
   try {
-    let res = await fetch(API + '/api/inventory/' + USER.telegram_id);
-    let items = await res.json();
+    // Pages arrive newest first; X-Next-Cursor points at the next one
     let grid = document.getElementById('inventory-grid');
-    if (!items.length) { grid.innerHTML = '<div class="inventory-empty">Инвентарь пуст</div>'; return; }
-    grid.innerHTML = items.map(i => `
-      <div class="inv-item" onclick="openInvAction(${i.id},'${i.image}','${i.name}',${i.sell_price})">
-        <div class="inv-item-icon">${i.image}</div>
-        <div class="inv-item-name">${i.name}</div>
-        <div class="inv-item-price">${i.sell_price} TON</div>
-      </div>
-    `).join('');
+    let cursor = null, first = true;
+    do {
+      let res = await fetch(API + '/api/inventory/' + USER.telegram_id + '?limit=200' + (cursor ? '&cursor=' + encodeURIComponent(cursor) : ''));
+      let items = await res.json();
+      cursor = res.headers.get('X-Next-Cursor');
+      if (first && !items.length) { grid.innerHTML = '<div class="inventory-empty">Инвентарь пуст</div>'; return; }
+      let html = items.map(i => `
+        <div class="inv-item" onclick="openInvAction(${i.id},'${i.image}','${i.name}',${i.sell_price})">
+          <div class="inv-item-icon">${i.image}</div>
+          <div class="inv-item-name">${i.name}${i.quantity > 1 ? ' ×' + i.quantity : ''}</div>
+          <div class="inv-item-price">${i.sell_price} TON</div>
+        </div>
+      `).join('');
+      if (first) grid.innerHTML = html; else grid.insertAdjacentHTML('beforeend', html);
+      first = false;
+    } while (cursor);
   } catch(e) {
     document.getElementById('inventory-grid').innerHTML = '<div class="inventory-empty">Инвентарь пуст</div>';
   }
@@ -123,7 +156,7 @@ function openInvAction(id, icon, name, price) {
 }
 async function sellInventoryItem() {
   try {
-    let res = await fetch(API + '/api/inventory/sell', { method:'POST', headers:{'Content-Type':'application/json'},
+    let res = await fetch(API + '/api/inventory/sell', { method:'POST', headers: apiHeaders(),
       body: JSON.stringify({ telegram_id: USER.telegram_id, item_id: _invActionId }) });
     let data = await res.json();
     if (data.success) {
@@ -137,23 +170,28 @@ async function sellInventoryItem() {
 }
 async function withdrawInventoryItem() {
   try {
-    let res = await fetch(API + '/api/inventory/withdraw_gift', { method:'POST', headers:{'Content-Type':'application/json'},
-      body: JSON.stringify({ item_id: _invActionId }) });
+    let res = await fetch(API + '/api/inventory/withdraw_gift', { method:'POST', headers: apiHeaders(),
+      body: JSON.stringify({ telegram_id: USER.telegram_id, item_id: _invActionId }) });
     let data = await res.json();
+    if (data.error) { showToast(data.error, 'error'); return; }
     document.getElementById('inv-action-msg').textContent = data.message;
     document.getElementById('inv-action-msg').style.display = 'block';
   } catch(e) { showToast('Ошибка', 'error'); }
 }
 async function sellAll() {
-  let res = await fetch(API + '/api/inventory/' + USER.telegram_id);
-  let items = await res.json();
-  for (let item of items) {
-    await fetch(API + '/api/inventory/sell', { method:'POST', headers:{'Content-Type':'application/json'},
-      body: JSON.stringify({ telegram_id: USER.telegram_id, item_id: item.id }) });
-  }
-  await refreshBalance();
-  loadInventory();
-  showToast('Все предметы проданы', 'success');
+  try {
+    let res = await fetch(API + '/api/inventory/sell_all', { method:'POST', headers: apiHeaders(),
+      body: JSON.stringify({ telegram_id: USER.telegram_id }) });
+    let data = await res.json();
+    if (data.success) {
+      USER.balance = data.new_balance;
+      updateBalanceDisplay();
+      showToast('Продано ' + data.sold_count + ' предм. за ' + data.sold_price + ' TON', 'success');
+    } else {
+      showToast('Нечего продавать', 'error');
+    }
+    loadInventory();
+  } catch(e) { showToast('Ошибка', 'error'); }
 }
 
 // ─── LEADERBOARD ────────────────────────────────────────────────
@@ -196,6 +234,7 @@ function openGameScreen(id) {
 function closeGameScreen(id) {
   document.getElementById('screen-' + id).classList.remove('active');
   currentGameScreen = null;
+  if (id === 'rolls') stopRolls();
 }
 
 // ── Gift Upgrade (Roulette) ──────────────────────────────────────
@@ -309,8 +348,7 @@ async function spinRoulette() {
 
   // API call
   try {
-    let res = await fetch(API + '/api/gift_upgrade/spin', { method:'POST', headers:{'Content-Type':'application/json'},
-      body: JSON.stringify({ telegram_id: USER.telegram_id, stake, multiplier: selectedMultiplier }) });
+    let res = await postOnce('/api/gift_upgrade/spin', { telegram_id: USER.telegram_id, stake, multiplier: selectedMultiplier });
     let data = await res.json();
 
     // Wait for animation to finish
@@ -373,6 +411,7 @@ let myBet = null;
 function openRolls() {
   document.getElementById('rolls-balance').textContent = USER.balance.toFixed(4) + ' TON';
   openGameScreen('rolls');
+  startRolls();
 }
 
 function buildRollsChips() {
@@ -386,52 +425,120 @@ function buildRollsChips() {
   strip.innerHTML = colors.map(c => `<div class="rolls-chip chip-${c}">💎</div>`).join('');
 }
 
-function startRollsPolling() {
-  if (rollsPolling) return;
+// Rolls updates are pushed over Server-Sent Events while the Rolls screen is open;
+// polling is the fallback when the stream is refused (503 past the server's cap),
+// can't be opened, or stays silent (e.g. a buffering proxy).
+const ROLLS_STREAM_FIRST_EVENT_MS = 4000;
+let rollsStream = null;
+let rollsStreamWatchdog = null;
+let rollsDeadline = 0;
+let rollsCountdownTimer = null;
+
+function startRolls() {
+  if (rollsPolling || rollsStream) return;
+  if (window.EventSource) startRollsStream();
+  else pollRollsInstead();
+}
+
+function stopRolls() {
+  if (rollsStream) rollsStream.close();
+  rollsStream = null;
+  clearTimeout(rollsStreamWatchdog);
+  clearInterval(rollsCountdownTimer);
+  clearInterval(rollsPolling);
+  rollsPolling = rollsCountdownTimer = rollsStreamWatchdog = null;
+}
+
+function pollRollsInstead() {
+  stopRolls();
+  pollRolls();
   rollsPolling = setInterval(pollRolls, 500);
 }
 
-async function pollRolls() {
-  try {
-    let res = await fetch(API + '/api/rolls/state');
-    let data = await res.json();
+function startRollsStream() {
+  let heard = false;
+  let stream = rollsStream = new EventSource(API + '/api/rolls/stream?telegram_id=' + USER.telegram_id);
+  let onEvent = () => { heard = true; clearTimeout(rollsStreamWatchdog); };
+  stream.addEventListener('tick', e => { onEvent(); setRollsCountdown(JSON.parse(e.data).countdown); });
+  stream.addEventListener('round', e => {
+    onEvent();
+    let data = JSON.parse(e.data);
+    renderRollsState(data);
+    if (data.payout) handleRollsPayout(data.payout);
+  });
+  stream.onerror = () => {
+    // EventSource reconnects by itself after a drop, but gives up (CLOSED) on a 503
+    if (stream === rollsStream && (!heard || stream.readyState === EventSource.CLOSED)) pollRollsInstead();
+  };
+  rollsStreamWatchdog = setTimeout(() => {
+    if (stream === rollsStream && !heard) pollRollsInstead();
+  }, ROLLS_STREAM_FIRST_EVENT_MS);
+  // Ticks arrive once a second; animate the countdown locally in between
+  rollsCountdownTimer = setInterval(() => {
+    if (rollsStream) renderRollsCountdown(Math.max(0, (rollsDeadline - performance.now()) / 1000));
+  }, 100);
+}
+
+// A Mini App in the background doesn't need the feed either
+document.addEventListener('visibilitychange', () => {
+  if (currentGameScreen !== 'rolls') return;
+  if (document.hidden) stopRolls();
+  else startRolls();
+});
 
-    // Update countdown
-    document.getElementById('rolls-countdown').textContent = data.countdown.toFixed(2);
+function setRollsCountdown(countdown) {
+  rollsDeadline = performance.now() + countdown * 1000;
+  renderRollsCountdown(countdown);
+}
 
-    // Update last result highlight
-    if (data.last_result) {
-      // Animate chips — shift and highlight center
-      animateRollsChips(data.last_result);
-    }
+function renderRollsCountdown(countdown) {
+  document.getElementById('rolls-countdown').textContent = countdown.toFixed(2);
+  // If betting is closed (countdown < 1), disable buttons visually
+  let btns = document.querySelectorAll('.rolls-color-btn');
+  btns.forEach(b => b.style.opacity = countdown < 1 ? '0.4' : '1');
+}
+
+function renderRollsState(data) {
+  setRollsCountdown(data.countdown);
 
-    // Mini history
-    let miniEl = document.getElementById('rolls-mini-history');
-    miniEl.innerHTML = (data.history || []).slice(0, 20).map(c => `<div class="rolls-mini-dot ${c}"></div>`).join('');
+  // Update last result highlight
+  if (data.last_result) {
+    // Animate chips — shift and highlight center
+    animateRollsChips(data.last_result);
+  }
+
+  // Mini history
+  let miniEl = document.getElementById('rolls-mini-history');
+  miniEl.innerHTML = (data.history || []).slice(0, 20).map(c => `<div class="rolls-mini-dot ${c}"></div>`).join('');
+
+  // Counts
+  document.getElementById('rolls-count-red').textContent = data.red_count;
+  document.getElementById('rolls-count-green').textContent = data.green_count;
+  document.getElementById('rolls-count-blue').textContent = data.blue_count;
+}
+
+async function handleRollsPayout(payout) {
+  if (payout.won) {
+    showToast('🎉 Выиграли! +' + payout.amount.toFixed(4) + ' TON (' + payout.mult + '×)', 'success');
+  } else {
+    showToast('💀 Проиграли ставку', 'error');
+  }
+  myBet = null;
+  document.getElementById('rolls-active-bet').style.display = 'none';
+  await refreshBalance();
+  document.getElementById('rolls-balance').textContent = USER.balance.toFixed(4) + ' TON';
+}
 
-    // Counts
-    document.getElementById('rolls-count-red').textContent = data.red_count;
-    document.getElementById('rolls-count-green').textContent = data.green_count;
-    document.getElementById('rolls-count-blue').textContent = data.blue_count;
+async function pollRolls() {
+  try {
+    let res = await fetch(API + '/api/rolls/state');
+    let data = await res.json();
+    renderRollsState(data);
 
     // Check if our bet was resolved
     if (data.last_payouts && data.last_payouts[USER.telegram_id.toString()]) {
-      let payout = data.last_payouts[USER.telegram_id.toString()];
-      if (payout.won) {
-        showToast('🎉 Выиграли! +' + payout.amount.toFixed(4) + ' TON (' + payout.mult + '×)', 'success');
-      } else {
-        showToast('💀 Проиграли ставку', 'error');
-      }
-      myBet = null;
-      document.getElementById('rolls-active-bet').style.display = 'none';
-      await refreshBalance();
-      document.getElementById('rolls-balance').textContent = USER.balance.toFixed(4) + ' TON';
+      await handleRollsPayout(data.last_payouts[USER.telegram_id.toString()]);
     }
-
-    // If betting is closed (countdown < 1), disable buttons visually
-    let btns = document.querySelectorAll('.rolls-color-btn');
-    btns.forEach(b => b.style.opacity = data.countdown < 1 ? '0.4' : '1');
-
   } catch(e) { /* offline */ }
 }
 
@@ -464,7 +571,7 @@ async function placeBet(color) {
   if (myBet) { showToast('Ставка уже сделана', 'error'); return; }
 
   try {
-    let res = await fetch(API + '/api/rolls/bet', { method:'POST', headers:{'Content-Type':'application/json'},
+    let res = await fetch(API + '/api/rolls/bet', { method:'POST', headers: apiHeaders(),
       body: JSON.stringify({ telegram_id: USER.telegram_id, color, amount }) });
     let data = await res.json();
     if (data.error) { showToast(data.error, 'error'); return; }
@@ -490,7 +597,7 @@ async function openMutants() {
   document.getElementById('mutants-balance').textContent = USER.balance.toFixed(4) + ' TON';
   // Check access
   try {
-    let res = await fetch(API + '/api/mutants/check', { method:'POST', headers:{'Content-Type':'application/json'},
+    let res = await fetch(API + '/api/mutants/check', { method:'POST', headers: apiHeaders(),
       body: JSON.stringify({ telegram_id: USER.telegram_id }) });
     let data = await res.json();
     document.getElementById('mutants-locked').classList.toggle('active', !data.available);
@@ -597,8 +704,7 @@ async function openCase(caseType) {
   // API call
   let apiData;
   try {
-    let res = await fetch(API + '/api/mutants/open_case', { method:'POST', headers:{'Content-Type':'application/json'},
-      body: JSON.stringify({ telegram_id: USER.telegram_id, case_type: caseType }) });
+    let res = await postOnce('/api/mutants/open_case', { telegram_id: USER.telegram_id, case_type: caseType });
     apiData = await res.json();
   } catch(e) {
     // Demo fallback
@@ -649,7 +755,7 @@ async function submitTonDeposit() {
   let amount = parseFloat(document.getElementById('dep-ton-amount').value);
   if (!amount || amount <= 0) { showToast('Введите сумму', 'error'); return; }
   try {
-    let res = await fetch(API + '/api/deposit/ton', { method:'POST', headers:{'Content-Type':'application/json'},
+    let res = await fetch(API + '/api/deposit/ton', { method:'POST', headers: apiHeaders(),
       body: JSON.stringify({ telegram_id: USER.telegram_id, amount }) });
     let data = await res.json();
     if (data.wallet_address) {
@@ -671,7 +777,7 @@ async function submitTonDeposit() {
 async function confirmTonDeposit() {
   if (!_currentDepositId) return;
   try {
-    let res = await fetch(API + '/api/deposit/confirm', { method:'POST', headers:{'Content-Type':'application/json'},
+    let res = await fetch(API + '/api/deposit/confirm', { method:'POST', headers: apiHeaders(),
       body: JSON.stringify({ deposit_id: _currentDepositId }) });
     let data = await res.json();
     if (data.success) {
@@ -698,8 +804,7 @@ async function submitStarsDeposit() {
   let stars = parseInt(document.getElementById('dep-stars-amount').value);
   if (!stars || stars < 100) { showToast('Минимум 100 Stars', 'error'); return; }
   try {
-    let res = await fetch(API + '/api/deposit/stars', { method:'POST', headers:{'Content-Type':'application/json'},
-      body: JSON.stringify({ telegram_id: USER.telegram_id, stars }) });
+    let res = await postOnce('/api/deposit/stars', { telegram_id: USER.telegram_id, stars });
     let data = await res.json();
     if (data.success) {
       USER.balance = data.new_balance;
@@ -753,8 +858,7 @@ async function submitWithdraw() {
   if (!wallet) { showToast('Введите адрес кошелёка', 'error'); return; }
   if (USER.balance < amount) { showToast('Недостаточный баланс', 'error'); return; }
   try {
-    let res = await fetch(API + '/api/withdraw/create', { method:'POST', headers:{'Content-Type':'application/json'},
-      body: JSON.stringify({ telegram_id: USER.telegram_id, amount, wallet_address: wallet }) });
+    let res = await postOnce('/api/withdraw/create', { telegram_id: USER.telegram_id, amount, wallet_address: wallet });
     let data = await res.json();
     if (data.success) {
       USER.balance = data.new_balance;
@@ -803,7 +907,7 @@ async function loadReferrals() {
 }
 async function withdrawRefBalance() {
   try {
-    let res = await fetch(API + '/api/referrals/withdraw', { method:'POST', headers:{'Content-Type':'application/json'},
+    let res = await fetch(API + '/api/referrals/withdraw', { method:'POST', headers: apiHeaders(),
       body: JSON.stringify({ telegram_id: USER.telegram_id }) });
     let data = await res.json();
     if (data.success) {